@@ -0,0 +1,145 @@
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+from src.compression import ContentCodec, train_dictionary
+
+from .corpus import WORDS
+
+TEMPLATES = (
+    '{word} {word} {word}',
+    'anyone up for {word} at {number}?',
+    '<@{snowflake}> {word} {word} {word} {word}',
+    'https://cdn.discordapp.com/attachments/{snowflake}/{snowflake}/image{number}.png',
+    '{word} {word} {word} {word} {word} {word} {word} {word} {word} {word}',
+    'lmao {word}',
+    '{word}, {word} {word} {word}. {word} {word} {word} {word} {word}!',
+)
+
+def synthetic_corpus(count, seed = 0):
+    rand = random.Random(seed)
+
+    def fill(template):
+        return template.format_map(Fill(rand))
+
+    return [fill(rand.choice(TEMPLATES)) for _ in range(count)]
+
+class Fill:
+    # Every {field} lookup draws a fresh value
+
+    def __init__(self, rand):
+        self._rand = rand
+
+    def __getitem__(self, key):
+        if key == 'word':
+            return self._rand.choice(WORDS)
+        if key == 'number':
+            return str(self._rand.randrange(1, 100))
+        return str(self._rand.getrandbits(60))
+
+def bench_codec(corpus, codec):
+    plain = sum(len(content.encode()) for content in corpus)
+
+    start = time.perf_counter()
+    blobs = [codec.compress(content) for content in corpus]
+    compress_time = time.perf_counter() - start
+
+    stored = sum(len(blob) if blob is not None else len(content.encode()) for content, blob in zip(corpus, blobs))
+
+    start = time.perf_counter()
+    for content, blob in zip(corpus, blobs):
+        if blob is not None:
+            codec.decompress(blob)
+    decompress_time = time.perf_counter() - start
+
+    return {
+        'plain_bytes': plain,
+        'stored_bytes': stored,
+        'ratio': plain / stored,
+        'compressed_rows': sum(blob is not None for blob in blobs),
+        'compress_rows_per_sec': len(corpus) / compress_time,
+        'decompress_rows_per_sec': len(corpus) / decompress_time,
+    }, blobs
+
+async def bench_postgres(dsn, corpus, codec, blobs):
+    # Temp tables so nothing is left behind, sizes come from the relation itself
+    import asyncpg
+
+    connection = await asyncpg.connect(dsn)
+    results = {}
+    try:
+        await connection.execute('CREATE TEMP TABLE bench_plain (id BIGINT PRIMARY KEY, content TEXT NOT NULL)')
+        await connection.execute("""
+            CREATE TEMP TABLE bench_zstd (
+                id BIGINT PRIMARY KEY, content TEXT NOT NULL, content_dict SMALLINT, content_zstd BYTEA
+            )
+        """)
+
+        plain_rows = [(i, content) for i, content in enumerate(corpus)]
+        zstd_rows = [
+            (i, content, None, None) if blob is None else (i, '', codec.dict_id, blob)
+            for i, (content, blob) in enumerate(zip(corpus, blobs))
+        ]
+
+        for table, rows in (('bench_plain', plain_rows), ('bench_zstd', zstd_rows)):
+            start = time.perf_counter()
+            await connection.copy_records_to_table(table, records = rows)
+            insert_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            fetched = await connection.fetch('SELECT * FROM {}'.format(table))
+            if table == 'bench_zstd':
+                for row in fetched:
+                    if row['content_dict'] is not None:
+                        codec.decompress(row['content_zstd'])
+            read_time = time.perf_counter() - start
+
+            await connection.execute('VACUUM ANALYZE {}'.format(table))
+            size = await connection.fetchval("SELECT pg_total_relation_size('{}')".format(table))
+            results[table] = {
+                'bytes': size,
+                'insert_rows_per_sec': len(rows) / insert_time,
+                'read_rows_per_sec': len(rows) / read_time,
+            }
+    finally:
+        await connection.close()
+    return results
+
+async def main(args):
+    if args.dsn and args.from_db:
+        import asyncpg
+        connection = await asyncpg.connect(args.dsn)
+        rows = await connection.fetch("SELECT content FROM messages WHERE content <> '' ORDER BY id DESC LIMIT $1", args.rows)
+        await connection.close()
+        corpus = [row['content'] for row in rows]
+    else:
+        corpus = synthetic_corpus(args.rows)
+
+    # Train on a slice and measure on everything, like a dictionary trained last week would be used
+    sample = corpus[:max(len(corpus) // 5, 1000)]
+    codec = ContentCodec(1, train_dictionary(sample, size = args.dict_size), level = args.level)
+
+    result, blobs = bench_codec(corpus, codec)
+    print('rows {}, dictionary {} bytes, level {}'.format(len(corpus), len(codec.data), args.level))
+    print('plain {plain_bytes} bytes, stored {stored_bytes} bytes, ratio {ratio:.2f}, {compressed_rows} rows compressed'.format(**result))
+    print('compress {compress_rows_per_sec:.0f} rows/s, decompress {decompress_rows_per_sec:.0f} rows/s'.format(**result))
+
+    if args.dsn:
+        for table, stats in (await bench_postgres(args.dsn, corpus, codec, blobs)).items():
+            print('{:<12} {:>10} bytes {:>10.0f} insert rows/s {:>10.0f} read rows/s'.format(
+                table, stats['bytes'], stats['insert_rows_per_sec'], stats['read_rows_per_sec']))
+    return 0
+
+if __name__ == '__main__':
+    # python -m bench.content_compression [--dsn postgres://...] [--from-db]
+    parser = argparse.ArgumentParser(description = 'Compare dictionary compressed content against plain text')
+    parser.add_argument('--rows', type = int, default = 100000)
+    parser.add_argument('--dict-size', type = int, default = 16 * 1024)
+    parser.add_argument('--level', type = int, default = 3)
+    parser.add_argument('--dsn', help = 'also measure insert/read throughput and table size in postgres')
+    parser.add_argument('--from-db', action = 'store_true', help = 'sample the corpus from the messages table')
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,154 @@
+import sys
+import time
+import zlib
+import random
+import msgspec
+
+from dlib.utils import DISCORD_EPOCH, to_json
+
+# Events the state has no parser for, they should cost us as little as possible
+UNSUBSCRIBED = ('TYPING_START', 'PRESENCE_UPDATE', 'MESSAGE_REACTION_ADD', 'SESSIONS_REPLACE')
+
+WORDS = (
+    'lol', 'yeah', 'anyone', 'know', 'how', 'to', 'fix', 'this', 'the', 'server', 'is', 'down',
+    'again', 'gg', 'wp', 'what', 'time', 'raid', 'tonight', 'brb', 'ok', 'nice', 'thanks', 'link'
+)
+
+class Snowflakes:
+
+    def __init__(self, rand):
+        self._rand = rand
+        self._increment = 0
+
+    def __call__(self):
+        self._increment = (self._increment + 1) & 0xfff
+        timestamp = int(time.time() * 1000) - DISCORD_EPOCH - self._rand.randrange(10**9)
+        return (timestamp << 22) | (self._rand.randrange(32) << 12) | self._increment
+
+def user_payload(rand, snowflake):
+    return {
+        'id': str(snowflake()),
+        'username': 'user{}'.format(rand.randrange(10**6)),
+        'discriminator': '{:04}'.format(rand.randrange(1, 10000)),
+        'avatar': '{:032x}'.format(rand.getrandbits(128)),
+        'public_flags': rand.choice((0, 0, 0, 64, 128, 256)),
+    }
+
+def channel_payload(rand, snowflake, position):
+    return {
+        'id': str(snowflake()),
+        'type': 0,
+        'flags': 0,
+        'name': 'channel-{}'.format(position),
+        'topic': None,
+        'position': position,
+        'nsfw': False,
+    }
+
+def guild_payload(rand, snowflake, channels):
+    return {
+        'id': str(snowflake()),
+        'name': 'guild {}'.format(rand.randrange(10**6)),
+        'verification_level': 1,
+        'icon': '{:032x}'.format(rand.getrandbits(128)),
+        'banner': None,
+        'emojis': [{'id': str(snowflake()), 'name': 'emoji{}'.format(i), 'animated': False} for i in range(20)],
+        'description': None,
+        'vanity_url_code': None,
+        'discovery_splash': None,
+        'owner_id': str(snowflake()),
+        'channels': [channel_payload(rand, snowflake, i) for i in range(channels)],
+    }
+
+def ready_payload(rand, snowflake, users, guilds, channels):
+    users = [user_payload(rand, snowflake) for _ in range(users)]
+    private_channels = [
+        {'id': str(snowflake()), 'type': 1, 'flags': 0, 'recipient_ids': [user['id']]}
+        for user in users[:50]
+    ]
+    me = user_payload(rand, snowflake)
+    me.update(verified=True, locale='en-US', mfa_enabled=False, flags=0)
+
+    return {
+        'v': 9,
+        'user': me,
+        'users': users,
+        'guilds': [guild_payload(rand, snowflake, channels) for _ in range(guilds)],
+        'private_channels': private_channels,
+        'session_id': '{:032x}'.format(rand.getrandbits(128)),
+    }
+
+def message_payload(rand, snowflake, guild, authors):
+    channel = rand.choice(guild['channels'])
+    return {
+        'id': str(snowflake()),
+        'type': 0,
+        'channel_id': channel['id'],
+        'guild_id': guild['id'],
+        'author': rand.choice(authors),
+        'content': ' '.join(rand.choice(WORDS) for _ in range(rand.randrange(1, 24))),
+        'mention_everyone': False,
+        'mentions': [],
+        'mention_roles': [],
+        'attachments': [],
+        'embeds': [],
+        'pinned': False,
+        'tts': False,
+        'timestamp': '2022-01-01T00:00:00.000000+00:00',
+        'edited_timestamp': None,
+        'flags': 0,
+    }
+
+def unsubscribed_payload(rand, snowflake, guild, event):
+    return {
+        'user_id': str(snowflake()),
+        'guild_id': guild['id'],
+        'channel_id': rand.choice(guild['channels'])['id'],
+        'timestamp': int(time.time()),
+        'status': 'online',
+        'event': event,
+    }
+
+def build_corpus(messages = 10000, unsubscribed = 5000, users = 2000, guilds = 50, channels = 30, seed = 0):
+    # Returns a list of (event, frame) pairs, frames are one zlib-stream like the gateway sends
+    rand = random.Random(seed)
+    snowflake = Snowflakes(rand)
+    compressor = zlib.compressobj()
+
+    def frame(event, data, sequence):
+        payload = to_json({'op': 0, 't': event, 's': sequence, 'd': data})
+        return compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    ready = ready_payload(rand, snowflake, users, guilds, channels)
+    # Half of the authors are new to the state
+    authors = ready['users'][:users // 2] + [user_payload(rand, snowflake) for _ in range(users // 2)]
+
+    kinds = ['MESSAGE_CREATE'] * messages + [None] * unsubscribed
+    rand.shuffle(kinds)
+
+    corpus = [('READY', frame('READY', ready, 1))]
+    for sequence, kind in enumerate(kinds, start = 2):
+        guild = rand.choice(ready['guilds'])
+        if kind is None:
+            kind = rand.choice(UNSUBSCRIBED)
+            data = unsubscribed_payload(rand, snowflake, guild, kind)
+        else:
+            data = message_payload(rand, snowflake, guild, authors)
+        corpus.append((kind, frame(kind, data, sequence)))
+
+    return corpus
+
+def save_corpus(path, corpus):
+    with open(path, 'wb') as fp:
+        fp.write(msgspec.msgpack.encode(corpus))
+
+def load_corpus(path):
+    with open(path, 'rb') as fp:
+        return [tuple(item) for item in msgspec.msgpack.decode(fp.read())]
+
+if __name__ == '__main__':
+    # python -m bench.corpus bench/corpus.bin
+    path = sys.argv[1] if len(sys.argv) > 1 else 'bench/corpus.bin'
+    corpus = build_corpus()
+    save_corpus(path, corpus)
+    print('Wrote {} frames, {} bytes to {}'.format(len(corpus), sum(len(f) for _, f in corpus), path))
@@ -0,0 +1,252 @@
+import sys
+import zlib
+import random
+import asyncio
+import argparse
+import datetime
+import logging
+import websockets
+
+from collections import Counter, deque
+
+from dlib.utils import to_json, from_json, time_snowflake
+
+from .corpus import Snowflakes, WORDS, ready_payload, user_payload
+
+_log = logging.getLogger(__name__)
+
+DISPATCH = 0
+HEARTBEAT = 1
+IDENTIFY = 2
+RESUME = 6
+RECONNECT = 7
+INVALIDATE_SESSION = 9
+HELLO = 10
+HEARTBEAT_ACK = 11
+
+class Session:
+    # What we need to resume, the last backlog dispatches are kept for replay
+
+    def __init__(self, session_id, backlog):
+        self.id = session_id
+        self.started = asyncio.get_running_loop().time()
+        self.sequence = 0
+        self.backlog = deque(maxlen = backlog)
+
+    def payload(self, event, data):
+        self.sequence += 1
+        payload = {'op': DISPATCH, 't': event, 's': self.sequence, 'd': data}
+        self.backlog.append(payload)
+        return payload
+
+    def can_resume(self, sequence):
+        # Only if nothing the client missed has fallen out of the backlog
+        if not self.backlog:
+            return sequence == self.sequence
+        return sequence is not None and sequence >= self.backlog[0]['s'] - 1
+
+class FakeGateway:
+    # Speaks enough of the gateway for Client.connect: HELLO, heartbeat ACKs, IDENTIFY/READY, RESUME/RESUMED,
+    # MESSAGE_CREATE at a fixed rate and RECONNECT/INVALIDATE_SESSION every so often
+
+    def __init__(self, host = '127.0.0.1', port = 0, rate = 20.0, users = 500, guilds = 10, channels = 10,
+                 heartbeat_interval = 10.0, reconnect_every = 0.0, invalidate_every = 0.0, backlog = 1000, seed = 0):
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.heartbeat_interval = heartbeat_interval
+        self.reconnect_every = reconnect_every
+        self.invalidate_every = invalidate_every
+        self.backlog = backlog
+
+        self._rand = random.Random(seed)
+        snowflake = Snowflakes(self._rand)
+        self._ready = ready_payload(self._rand, snowflake, users, guilds, channels)
+        self._authors = self._ready['users'][:users // 2] + [user_payload(self._rand, snowflake) for _ in range(users // 2)]
+        self._increment = 0
+
+        self.sessions = {}
+        self._server = None
+
+        # Counters for the soak runner
+        self.connections = 0
+        self.identifies = 0
+        self.resumes = 0
+        self.failed_resumes = 0
+        self.reconnects = 0
+        self.invalidations = 0
+        self.messages = 0
+        self.close_codes = Counter()
+
+    @property
+    def url(self):
+        return 'ws://{}:{}'.format(self.host, self.port)
+
+    def stats(self):
+        return {
+            'connections': self.connections,
+            'identifies': self.identifies,
+            'resumes': self.resumes,
+            'failed_resumes': self.failed_resumes,
+            'reconnects': self.reconnects,
+            'invalidations': self.invalidations,
+            'messages': self.messages,
+            'close_codes': dict(self.close_codes),
+        }
+
+    async def start(self):
+        # Discord doesn't negotiate permessage-deflate, the payload has its own zlib stream
+        self._server = await websockets.serve(self._handle, self.host, self.port, max_size = None, compression = None)
+        self.port = self._server.sockets[0].getsockname()[1]
+        _log.info('fake gateway: listening on %s', self.url)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def _message(self):
+        # Ids carry the send time, the client can work out the event lag from them
+        guild = self._rand.choice(self._ready['guilds'])
+        self._increment = (self._increment + 1) & 0xfff
+        return {
+            'id': str(time_snowflake(datetime.datetime.now(datetime.timezone.utc)) | self._increment),
+            'type': 0,
+            'channel_id': self._rand.choice(guild['channels'])['id'],
+            'guild_id': guild['id'],
+            'author': self._rand.choice(self._authors),
+            'content': ' '.join(self._rand.choice(WORDS) for _ in range(self._rand.randrange(1, 24))),
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'pinned': False,
+            'tts': False,
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'edited_timestamp': None,
+            'flags': 0,
+        }
+
+    async def _handle(self, connection):
+        self.connections += 1
+        compressor = zlib.compressobj()
+
+        async def send(payload):
+            # One zlib stream per connection, flushed per message like discord does
+            await connection.send(compressor.compress(to_json(payload)) + compressor.flush(zlib.Z_SYNC_FLUSH))
+
+        session = None
+        try:
+            await send({'op': HELLO, 'd': {'heartbeat_interval': int(self.heartbeat_interval * 1000)}})
+            session = await self._handshake(connection, send)
+            if session is not None:
+                await self._serve(connection, send, session)
+        except websockets.ConnectionClosed:
+            pass
+
+        # Discord ends the session on a 1000/1001 close, anything else leaves it resumable
+        code = connection.close_code
+        self.close_codes[code] += 1
+        if session is not None and code in (1000, 1001):
+            self.sessions.pop(session.id, None)
+
+    async def _handshake(self, connection, send):
+        while True:
+            msg = from_json(await connection.recv())
+            if msg['op'] == HEARTBEAT:
+                await send({'op': HEARTBEAT_ACK})
+                continue
+
+            if msg['op'] == IDENTIFY:
+                self.identifies += 1
+                session = Session('{:032x}'.format(self._rand.getrandbits(128)), self.backlog)
+                self.sessions[session.id] = session
+                ready = dict(self._ready, session_id = session.id, resume_gateway_url = self.url)
+                await send(session.payload('READY', ready))
+                return session
+
+            if msg['op'] == RESUME:
+                data = msg['d']
+                session = self.sessions.get(data['session_id'])
+                if session is None or not session.can_resume(data['seq']):
+                    self.failed_resumes += 1
+                    await send({'op': INVALIDATE_SESSION, 'd': False})
+                    await connection.wait_closed()
+                    return None
+
+                self.resumes += 1
+                for payload in list(session.backlog):
+                    if payload['s'] > data['seq']:
+                        await send(payload)
+                await send(session.payload('RESUMED', {}))
+                return session
+
+    async def _serve(self, connection, send, session):
+        reader = asyncio.create_task(self._read(connection, send))
+        writer = asyncio.create_task(self._write(connection, send, session))
+        try:
+            await asyncio.wait((reader, writer), return_when = asyncio.FIRST_COMPLETED)
+        finally:
+            reader.cancel()
+            writer.cancel()
+
+    async def _read(self, connection, send):
+        async for msg in connection:
+            if from_json(msg)['op'] == HEARTBEAT:
+                await send({'op': HEARTBEAT_ACK})
+
+    async def _write(self, connection, send, session):
+        loop = asyncio.get_running_loop()
+        connected = deadline = loop.time()
+
+        while True:
+            # Catch up in bursts when the loop falls behind instead of drifting
+            deadline += 1 / self.rate
+            await asyncio.sleep(max(deadline - loop.time(), 0))
+            await send(session.payload('MESSAGE_CREATE', self._message()))
+            self.messages += 1
+
+            # Sessions get invalidated by age, they can outlive many reconnects
+            now = loop.time()
+            if self.invalidate_every and now - session.started >= self.invalidate_every:
+                self.invalidations += 1
+                del self.sessions[session.id]
+                await send({'op': INVALIDATE_SESSION, 'd': False})
+                return await connection.wait_closed()
+
+            if self.reconnect_every and now - connected >= self.reconnect_every:
+                self.reconnects += 1
+                await send({'op': RECONNECT})
+                return await connection.wait_closed()
+
+async def main(args):
+    gateway = FakeGateway(
+        host = args.host,
+        port = args.port,
+        rate = args.rate,
+        reconnect_every = args.reconnect_every,
+        invalidate_every = args.invalidate_every
+    )
+    await gateway.start()
+    print('Serving a fake gateway on {}, point Client(gateway_url = ...) at it'.format(gateway.url))
+    try:
+        await asyncio.Future()
+    finally:
+        await gateway.close()
+
+if __name__ == '__main__':
+    # python -m bench.fake_gateway [--port 8765] [--rate 50] [--reconnect-every 300]
+    parser = argparse.ArgumentParser(description = 'Local stand-in for the discord gateway')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--rate', type = float, default = 20.0, help = 'MESSAGE_CREATE per second per connection')
+    parser.add_argument('--reconnect-every', type = float, default = 0.0, help = 'seconds between RECONNECT requests')
+    parser.add_argument('--invalidate-every', type = float, default = 0.0, help = 'seconds between invalidated sessions')
+    args = parser.parse_args()
+
+    try:
+        sys.exit(asyncio.run(main(args)))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,174 @@
+import sys
+import time
+import asyncio
+import argparse
+import tracemalloc
+import msgspec
+
+import dlib
+from dlib.client import DEVICES
+from dlib.gateway import DiscordWebsocket
+
+from .corpus import build_corpus, load_corpus
+
+class ReplaySocket:
+    # Stands in for the websocket, we only ever send presence updates during replay
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send(self, data):
+        self.sent += 1
+
+class ReplayClient(dlib.Client):
+
+    async def on_ready(self):
+        pass
+
+    async def on_new_user(self, ctx):
+        pass
+
+    async def on_message(self, ctx):
+        pass
+
+def create_client(loop):
+    client = ReplayClient(loop = loop, token = 'x' * 59)
+    # Clients take a device from a small pool, give it back so we can run many passes
+    DEVICES.append(client._device)
+    return client
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def replay(corpus, trace = False):
+    # Feeds every frame through received_message -> parsers -> dispatch on a fresh client
+    loop = asyncio.get_running_loop()
+    client = create_client(loop)
+    ws = DiscordWebsocket(loop = loop, client = client)
+    socket = ReplaySocket()
+    parsers = client._connection.parsers
+
+    latencies = {}
+    allocations = {}
+
+    if trace:
+        tracemalloc.start()
+
+    for event, frame in corpus:
+        label = event if event in parsers else 'unsubscribed'
+
+        if trace:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            await ws.received_message(socket, frame)
+            _, peak = tracemalloc.get_traced_memory()
+            allocations.setdefault(label, []).append(peak - before)
+        else:
+            start = time.perf_counter()
+            await ws.received_message(socket, frame)
+            latencies.setdefault(label, []).append(time.perf_counter() - start)
+
+        # Let the dispatched handlers run outside of the measurement
+        await asyncio.sleep(0)
+
+    if trace:
+        tracemalloc.stop()
+
+    await client._dispatcher.close()
+    return latencies, allocations
+
+def summarize(latencies, allocations):
+    results = {}
+    for label, values in latencies.items():
+        allocated = allocations.get(label, [])
+        results[label] = {
+            'events': len(values),
+            'events_per_sec': len(values) / sum(values) if sum(values) else 0.0,
+            'p50_us': percentile(values, 0.50) * 1e6,
+            'p99_us': percentile(values, 0.99) * 1e6,
+            'alloc_bytes_per_event': sum(allocated) / len(allocated) if allocated else 0.0,
+        }
+
+    values = [value for label in latencies.values() for value in label]
+    allocated = [value for label in allocations.values() for value in label]
+    results['total'] = {
+        'events': len(values),
+        'events_per_sec': len(values) / sum(values) if sum(values) else 0.0,
+        'p50_us': percentile(values, 0.50) * 1e6,
+        'p99_us': percentile(values, 0.99) * 1e6,
+        'alloc_bytes_per_event': sum(allocated) / len(allocated) if allocated else 0.0,
+    }
+    return results
+
+def print_results(results):
+    print('{:<16} {:>8} {:>12} {:>10} {:>10} {:>14}'.format(
+        'event', 'count', 'events/s', 'p50 us', 'p99 us', 'alloc B/event'))
+    for label, result in results.items():
+        print('{:<16} {:>8} {:>12.0f} {:>10.1f} {:>10.1f} {:>14.0f}'.format(
+            label,
+            result['events'],
+            result['events_per_sec'],
+            result['p50_us'],
+            result['p99_us'],
+            result['alloc_bytes_per_event']
+        ))
+
+def compare(results, baseline, threshold):
+    # Returns the labels whose throughput dropped by more than threshold
+    regressions = []
+    for label, result in results.items():
+        if label not in baseline:
+            continue
+        expected = baseline[label]['events_per_sec']
+        if expected and result['events_per_sec'] < expected * (1 - threshold):
+            regressions.append((label, expected, result['events_per_sec']))
+    return regressions
+
+async def main(args):
+    corpus = load_corpus(args.corpus) if args.corpus else build_corpus(messages = args.messages)
+
+    # Warm up caches and imports, then time and trace in separate passes
+    await replay(corpus)
+    runs = [(await replay(corpus))[0] for _ in range(args.repeat)]
+    _, allocations = await replay(corpus, trace = True)
+
+    # Keep the fastest run per event type, the others are noise from the machine
+    latencies = {}
+    for run in runs:
+        for label, values in run.items():
+            if label not in latencies or sum(values) < sum(latencies[label]):
+                latencies[label] = values
+
+    results = summarize(latencies, allocations)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'wb') as fp:
+            fp.write(msgspec.json.encode(results))
+
+    if args.baseline:
+        with open(args.baseline, 'rb') as fp:
+            baseline = msgspec.json.decode(fp.read())
+
+        regressions = compare(results, baseline, args.threshold)
+        for label, expected, actual in regressions:
+            print('REGRESSION {}: {:.0f} -> {:.0f} events/s'.format(label, expected, actual))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    # python -m bench.replay [--corpus bench/corpus.bin] [--output new.json] [--baseline old.json]
+    parser = argparse.ArgumentParser(description = 'Replay recorded gateway frames through the ingest path')
+    parser.add_argument('--corpus', help = 'corpus written by bench.corpus, generated when omitted')
+    parser.add_argument('--messages', type = int, default = 10000)
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--output', help = 'write the results as json')
+    parser.add_argument('--baseline', help = 'results json to compare against')
+    parser.add_argument('--threshold', type = float, default = 0.10, help = 'allowed throughput drop')
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,101 @@
+import sys
+import time
+import random
+import argparse
+
+from src.delta import SNAPSHOT_INTERVAL, encode_revision, rebuild
+
+from .corpus import WORDS
+from .replay import percentile
+
+def edit(rand, content):
+    # The edits people actually make: fix a word, add a bit, drop a bit, sometimes rewrite it all
+    words = content.split(' ')
+    kind = rand.random()
+    if kind < 0.45:
+        words[rand.randrange(len(words))] = rand.choice(WORDS)
+    elif kind < 0.75:
+        words.insert(rand.randrange(len(words) + 1), rand.choice(WORDS))
+    elif kind < 0.90 and len(words) > 1:
+        del words[rand.randrange(len(words))]
+    elif kind < 0.97:
+        words.extend(rand.choice(WORDS) for _ in range(rand.randrange(1, 8)))
+    else:
+        words = [rand.choice(WORDS) for _ in range(rand.randrange(1, 40))]
+    return ' '.join(words)
+
+def build_histories(messages, edits, seed = 0):
+    # Edits per message follow a long tail, a few messages are edited over and over
+    rand = random.Random(seed)
+    histories = []
+    for _ in range(messages):
+        content = ' '.join(rand.choice(WORDS) for _ in range(rand.randrange(3, 80)))
+        history = [content]
+        for _ in range(min(int(rand.paretovariate(1.2)) - 1, edits)):
+            content = edit(rand, content)
+            history.append(content)
+        histories.append(history)
+    return histories
+
+def bench(histories):
+    full = stored = revisions = snapshots = 0
+    chains = []
+
+    start = time.perf_counter()
+    for history in histories:
+        chain = []
+        for revision in range(1, len(history)):
+            snapshot, delta = encode_revision(revision, history[revision - 1], history[revision])
+            chain.append((snapshot, delta))
+
+            full += len(history[revision].encode())
+            stored += len(snapshot.encode()) if snapshot is not None else len(delta)
+            snapshots += snapshot is not None
+            revisions += 1
+        chains.append(chain)
+    encode_time = time.perf_counter() - start
+
+    # Rebuild every revision the way get_revision does, from the newest snapshot at or below it
+    latencies = []
+    for history, chain in zip(histories, chains):
+        for revision in range(1, len(history)):
+            start = time.perf_counter()
+            first = revision
+            while first > 0 and chain[first - 1][0] is None:
+                first -= 1
+            content = rebuild(history[0] if first == 0 else None, chain[max(first - 1, 0):revision])
+            latencies.append(time.perf_counter() - start)
+
+            if content != history[revision]:
+                raise AssertionError('revision {} rebuilt wrong'.format(revision))
+
+    return {
+        'revisions': revisions,
+        'snapshots': snapshots,
+        'full_bytes': full,
+        'stored_bytes': stored,
+        'ratio': full / stored if stored else 0.0,
+        'encode_per_sec': revisions / encode_time if encode_time else 0.0,
+        'rebuild_p50_us': percentile(latencies, 0.50) * 1e6,
+        'rebuild_p99_us': percentile(latencies, 0.99) * 1e6,
+    }
+
+def main(args):
+    histories = build_histories(args.messages, args.max_edits, seed = args.seed)
+    result = bench(histories)
+
+    print('{} messages, {revisions} revisions, {snapshots} snapshots, snapshot interval {}'.format(
+        len(histories), SNAPSHOT_INTERVAL, **result))
+    print('full copies {full_bytes} bytes, deltas {stored_bytes} bytes, ratio {ratio:.2f}'.format(**result))
+    print('encode {encode_per_sec:.0f} revisions/s, rebuild p50 {rebuild_p50_us:.1f}us p99 {rebuild_p99_us:.1f}us'.format(**result))
+    return 0
+
+if __name__ == '__main__':
+    # python -m bench.revisions [--messages 20000]
+    parser = argparse.ArgumentParser(description = 'Compare delta encoded edit history against full copies')
+    parser.add_argument('--messages', type = int, default = 20000)
+    parser.add_argument('--max-edits', type = int, default = 200)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    sys.exit(main(args))
@@ -0,0 +1,204 @@
+import gc
+import os
+import sys
+import time
+import asyncio
+import argparse
+import logging
+import resource
+import tracemalloc
+import msgspec
+
+import dlib
+from dlib.client import DEVICES
+from dlib.metrics import Histogram
+from dlib.utils import DISCORD_EPOCH
+
+from .fake_gateway import FakeGateway
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def rss_bytes():
+    # Current resident size, getrusage only knows the peak
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class SoakClient(dlib.Client):
+
+    def __init__(self, *args, lag, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lag = lag
+        self.received = 0
+
+    async def on_ready(self):
+        pass
+
+    async def on_new_user(self, ctx):
+        pass
+
+    async def on_message(self, ctx):
+        # The fake gateway stamps the send time into the id
+        self.received += 1
+        self._lag.observe(max(time.time() - ((ctx.id >> 22) + DISCORD_EPOCH) / 1000, 0.0))
+
+class Sample(msgspec.Struct):
+    elapsed: float
+    rss: int
+    traced: int
+    tasks: int
+    received: int
+    event_lag_p99: float
+    loop_lag_max: float
+
+def take_sample(started, clients, lag, watchdog):
+    traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+    return Sample(
+        elapsed = time.monotonic() - started,
+        rss = rss_bytes(),
+        traced = traced,
+        tasks = len(asyncio.all_tasks()),
+        received = sum(client.received for client in clients),
+        event_lag_p99 = lag.quantile(0.99),
+        loop_lag_max = watchdog.max_lag
+    )
+
+def print_sample(sample):
+    print('{:>8.0f}s rss {:>8.1f}MB traced {:>8.1f}MB tasks {:>5} received {:>10} event lag p99 {:>7.3f}s loop lag max {:>7.3f}s'.format(
+        sample.elapsed,
+        sample.rss / 2**20,
+        sample.traced / 2**20,
+        sample.tasks,
+        sample.received,
+        sample.event_lag_p99,
+        sample.loop_lag_max
+    ))
+
+def check(baseline, final, args):
+    # Returns what grew past its threshold, compared against the sample taken after the warmup
+    failures = []
+    growth = (final.rss - baseline.rss) / 2**20
+    if growth > args.max_rss_growth:
+        failures.append('rss grew {:.1f}MB, allowed {:.1f}MB'.format(growth, args.max_rss_growth))
+
+    growth = (final.traced - baseline.traced) / 2**20
+    if tracemalloc.is_tracing() and growth > args.max_traced_growth:
+        failures.append('traced memory grew {:.1f}MB, allowed {:.1f}MB'.format(growth, args.max_traced_growth))
+
+    growth = final.tasks - baseline.tasks
+    if growth > args.max_task_growth:
+        failures.append('{} more tasks than after the warmup, allowed {}'.format(growth, args.max_task_growth))
+
+    if final.event_lag_p99 > args.max_event_lag:
+        failures.append('event lag p99 {:.3f}s, allowed {:.3f}s'.format(final.event_lag_p99, args.max_event_lag))
+    return failures
+
+async def main(args):
+    loop = asyncio.get_running_loop()
+    gateway = FakeGateway(
+        rate = args.rate,
+        users = args.users,
+        heartbeat_interval = args.heartbeat_interval,
+        reconnect_every = args.reconnect_every,
+        invalidate_every = args.invalidate_every
+    )
+    await gateway.start()
+
+    watchdog = dlib.LoopWatchdog(loop)
+    watchdog.start()
+
+    if args.tracemalloc:
+        tracemalloc.start(args.tracemalloc)
+
+    lag = Histogram()
+    clients = []
+    for i in range(args.clients):
+        client = SoakClient(loop = loop, token = 'soak{:012d}'.format(i) + 'x' * 43, gateway_url = gateway.url,
+            max_users = args.max_users, lag = lag)
+        # Devices come from a small pool, hand it back so the client count isn't capped by it
+        DEVICES.append(client._device)
+        clients.append(client)
+
+    tasks = [loop.create_task(client.connect()) for client in clients]
+    started = time.monotonic()
+    baseline = baseline_snapshot = None
+    samples = []
+
+    try:
+        while time.monotonic() - started < args.duration:
+            await asyncio.sleep(min(args.interval, max(args.duration - (time.monotonic() - started), 0)))
+
+            dead = [task for task in tasks if task.done()]
+            if dead:
+                print('{} clients stopped: {}'.format(len(dead), dead[0].exception() or 'gave up reconnecting'))
+                return 1
+
+            sample = take_sample(started, clients, lag, watchdog)
+            samples.append(sample)
+            print_sample(sample)
+
+            # Caches fill up during the warmup, growth is measured from here on
+            if baseline is None and sample.elapsed >= args.warmup:
+                gc.collect()
+                baseline = take_sample(started, clients, lag, watchdog)
+                if tracemalloc.is_tracing():
+                    baseline_snapshot = tracemalloc.take_snapshot()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+
+        for client in clients:
+            await client._dispatcher.close()
+        await gateway.close()
+        await watchdog.close()
+
+    gc.collect()
+    final = take_sample(started, clients, lag, watchdog)
+    print('gateway: {}'.format(gateway.stats()))
+
+    if baseline_snapshot is not None:
+        print('top allocations since the warmup:')
+        for stat in tracemalloc.take_snapshot().compare_to(baseline_snapshot, 'lineno')[:args.top]:
+            print('  {}'.format(stat))
+
+    if args.output:
+        with open(args.output, 'wb') as fp:
+            fp.write(msgspec.json.encode({'samples': samples, 'gateway': gateway.stats()}))
+
+    if baseline is None:
+        print('run ended inside the warmup, nothing to compare')
+        return 0
+
+    failures = check(baseline, final, args)
+    for failure in failures:
+        print('FAIL {}'.format(failure))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    # python -m bench.soak --duration 14400 --clients 4 --rate 50 --reconnect-every 600
+    parser = argparse.ArgumentParser(description = 'Run clients against a local fake gateway and watch for growth')
+    parser.add_argument('--duration', type = float, default = 3600.0, help = 'seconds')
+    parser.add_argument('--interval', type = float, default = 60.0, help = 'seconds between samples')
+    parser.add_argument('--warmup', type = float, default = 300.0, help = 'seconds before the baseline sample')
+    parser.add_argument('--clients', type = int, default = 2)
+    parser.add_argument('--rate', type = float, default = 20.0, help = 'MESSAGE_CREATE per second per connection')
+    parser.add_argument('--users', type = int, default = 500)
+    parser.add_argument('--max-users', type = int, default = 100000, help = 'user cache size per client')
+    parser.add_argument('--heartbeat-interval', type = float, default = 10.0)
+    parser.add_argument('--reconnect-every', type = float, default = 0.0)
+    parser.add_argument('--invalidate-every', type = float, default = 0.0)
+    parser.add_argument('--tracemalloc', type = int, default = 1, help = 'frames to keep per allocation, 0 disables it')
+    parser.add_argument('--top', type = int, default = 10)
+    parser.add_argument('--max-rss-growth', type = float, default = 50.0, help = 'MB')
+    parser.add_argument('--max-traced-growth', type = float, default = 20.0, help = 'MB')
+    parser.add_argument('--max-task-growth', type = int, default = 10)
+    parser.add_argument('--max-event-lag', type = float, default = 1.0, help = 'seconds, p99')
+    parser.add_argument('--output', help = 'write the samples as json')
+    parser.add_argument('--log-level', default = 'WARNING')
+    args = parser.parse_args()
+
+    dlib.setup_logging(level = getattr(logging, args.log_level.upper()), names = ('dlib', 'bench'))
+    sys.exit(asyncio.run(main(args)))
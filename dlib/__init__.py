@@ -1,6 +1,10 @@
 import logging
 
 from .client import Client
+from .metrics import REGISTRY, MetricsServer
+from .profiling import PROFILER
+from .watchdog import LoopWatchdog
+from .log import setup_logging
 
 # Yeah we should?
 logging.getLogger(__name__).addHandler(logging.NullHandler())
@@ -1,21 +1,44 @@
+from .store import intern_string
+
 class PrivateChannel:
 
-    def __init__(self, me, state, data):
+    __slots__ = ('type', 'id', 'flags', 'guild', 'recipients')
+
+    def __init__(self, me, state, data, users = None):
         self.type = int(data['type'])
         self.id = int(data['id'])
-        self.flags = int(data['flags'])
         self.guild = None
-        self.recipients = [state._users[int(uid)] for uid in data['recipient_ids']]
+        self._update(state, data, users)
+
+    def _update(self, state, data, users = None):
+        # users maps ids to the raw READY user payloads, recipient_ids only point into those
+        self.flags = int(data.get('flags', 0))
+        if 'recipient_ids' in data:
+            self.recipients = []
+            for uid in data['recipient_ids']:
+                user = state._users.get(int(uid))
+                if user is None and users is not None and int(uid) in users:
+                    # A big READY can evict recipients from the store before we get here
+                    user = state.store_user(users[int(uid)])
+                if user is not None:
+                    self.recipients.append(user)
+        else:
+            # CHANNEL_CREATE and CHANNEL_UPDATE send the full users
+            self.recipients = [state.store_user(user) for user in data.get('recipients', ())]
 
     def __str__(self):
-         return 'Direct message with {}'.format(self.recipients[0])
+         return self.name
 
     @property
     def name(self):
+        if not self.recipients:
+            return 'Direct message {}'.format(self.id)
         return 'Direct message with {}'.format(self.recipients[0])
 
 class DMChannel:
 
+    __slots__ = ('_state', 'recipient', 'me', 'id')
+
     def __init__(self, me, state, data):
         self._state = state
         self.recipient = data['recipients'][0]
@@ -37,19 +60,35 @@ class DMChannel:
         return self
 
 class TextChannel:
+
+    __slots__ = ('id', 'type', 'nsfs', 'flags', 'name', 'topic', 'guild', 'position')
     
     def __init__(self, state, guild, data):
         self.id = int(data['id'])
+        self.guild = guild
+        self._update(data)
+
+    def _update(self, data):
         self.type = int(data['type'])
         self.nsfs = int(data['nsfw']) if 'nsfw' in data.keys() else None
         self.flags = int(data['flags'])
-        self.name = data['name']
+        self.name = intern_string(data['name'])
         self.topic = data['topic']
-        self.guild = guild
         self.position = int(data['position'])
 
-        # Add the guild
-
     def __str__(self):
         return '{}, {}, {}, {}'.format(self.id, self.name, self.flags, self.topic)
 
+
+class PartialChannel:
+    # Stands in for channels we keep no state for (threads, voice text), enough for a message to point at
+
+    __slots__ = ('id', 'guild')
+    name = None
+
+    def __init__(self, channel_id, guild = None):
+        self.id = channel_id
+        self.guild = guild
+
+    def __str__(self):
+        return str(self.id)
@@ -1,11 +1,16 @@
+import os
 import time
 import logging
 import asyncio
+import msgspec
 import websockets
 
 from .device import create_devices
 
 from .backoff import ExponentialBackoff
+from .dispatch import EventDispatcher, BLOCK
+from .metrics import REGISTRY
+from .profiling import PROFILER
 from .state import ConnectionState
 from .gateway import DiscordWebsocket, ReconnectWebSocket
 
@@ -13,10 +18,18 @@ _log = logging.getLogger(__name__)
 
 DEVICES = create_devices()
 
+# Authentication failed, sharding or intents problems, reconnecting won't fix these
+FATAL_CLOSE_CODES = frozenset((4004, 4010, 4011, 4012, 4013, 4014))
+# Invalid sequence and session timeout, the session is gone and we have to identify
+SESSION_CLOSE_CODES = frozenset((4007, 4009))
+
 
 class Client:
     
-    def __init__(self, loop, token):
+    def __init__(self, loop, token, raw_events = (), dispatch_workers = 4, dispatch_queue = 1000,
+                 overflow = BLOCK, batch_size = 100, batch_age = 0.5, max_users = 100000,
+                 max_messages = 1000, offload_threshold = 64 * 1024, gateway_url = 'wss://gateway.discord.gg',
+                 session_dir = None):
         self.loop = loop
         self.token = token
         self.id = token[:16]
@@ -24,14 +37,41 @@ class Client:
         self.http = None
         self._listeners = {}
         self._closed = False
+        self._reading = False
+        self._connect_task = None
+        # close() leaves the session here and the next connect() resumes it instead of identifying
+        self.session_path = os.path.join(session_dir, '{}.session'.format(self.id)) if session_dir else None
+        self.gateway_url = gateway_url
+        # Consecutive reconnects that never got a session back
         self.max_reconnects = 10
         self._reconnects = 0
 
+        self.metrics = REGISTRY
+        self.profiler = PROFILER
+        self._m_reconnects = self.metrics.counter('dlib_client_reconnects_total', 'Gateway reconnects', client=self.id)
+
+        # Events without a parser that should still be decoded and dispatched as on_raw_<event>
+        self.raw_events = frozenset(raw_events)
+        # Compressed size above which a message is inflated and decoded in a thread, 0 keeps everything on the loop
+        self.offload_threshold = offload_threshold
+
+        # Handlers run on a bounded worker pool instead of a task per event
+        self._dispatcher = EventDispatcher(
+            client = self,
+            workers = dispatch_workers,
+            max_queue = dispatch_queue,
+            overflow = overflow,
+            batch_size = batch_size,
+            batch_age = batch_age
+        )
+
         # Instantiate the state manager
         self._connection = ConnectionState(
             dispatch = self.dispatch,
             http = None,
-            loop = self.loop
+            loop = self.loop,
+            max_users = max_users,
+            max_messages = max_messages
         )
         # Late to the game i guess?
         self._connection.id = self.id
@@ -39,58 +79,176 @@ class Client:
         # Fetch a device from the poo
         self._device = DEVICES.pop(0)
 
-    async def _run_event(self, coro, event_name, *args, **kwargs):
-        await coro(*args, **kwargs)
-
-    def _schedule_event(self, coro, event_name, *args, **kwargs):
-        wrapped = self._run_event(coro, event_name, *args, **kwargs)
-        
-        # Schedules the task
-        return asyncio.create_task(wrapped, name = event_name)
-
     def dispatch(self, event, *args, **kwargs):
-        method = 'on_{}'.format(event)
-        coro = getattr(self, method)
-
-        self._schedule_event(coro, method, *args, **kwargs)
+        self._dispatcher.dispatch(event, *args, **kwargs)
     
     @property
     def _ws_client_params(self):
-        size = 1024 * 1024 * 2.5
+        size = int(1024 * 1024 * 2.5)
 
+        # read_limit only exists in the legacy client, websockets >= 14 rejects it
         return {
             'max_size': size,
-            'read_limit': size,
             'write_limit': size
         }
 
+    def load_session(self):
+        # A checkpoint is only good for one resume, two processes must never share a session
+        if self.session_path is None:
+            return {}
+
+        try:
+            with open(self.session_path, 'rb') as fp:
+                session = msgspec.json.decode(fp.read())
+        except FileNotFoundError:
+            return {}
+        except msgspec.DecodeError:
+            _log.warning('[%s] gateway: ignoring unreadable session checkpoint %s', self.id, self.session_path)
+            session = None
+        os.remove(self.session_path)
+
+        if not session:
+            return {}
+
+        _log.info('[%s] gateway: resuming checkpointed session at sequence=%s', self.id, session['sequence'])
+        return {
+            'session_id': session['session_id'],
+            'sequence': session['sequence'],
+            'resume_url': session.get('resume_url'),
+            'resume': True
+        }
+
+    def save_session(self):
+        ws = self.ws
+        if self.session_path is None or ws is None or ws.session_id is None:
+            return False
+
+        os.makedirs(os.path.dirname(self.session_path) or '.', exist_ok=True)
+        # Write and rename so a crash never leaves half a checkpoint
+        temp = self.session_path + '.tmp'
+        with open(temp, 'wb') as fp:
+            fp.write(msgspec.json.encode({
+                'session_id': ws.session_id,
+                'sequence': ws.sequence,
+                'resume_url': ws.resume_url,
+                'saved_at': time.time()
+            }))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp, self.session_path)
+
+        _log.info('[%s] gateway: saved session at sequence=%s', self.id, ws.sequence)
+        return True
+
+    async def close(self, timeout = 10.0):
+        # Stop reading, give the handlers until the deadline and keep the session for the next start
+        if self._closed:
+            return None
+        self._closed = True
+        deadline = self.loop.time() + timeout
+
+        task = self._connect_task
+        if task is not None and not task.done():
+            if self._reading:
+                await self.ws.close()
+                await asyncio.wait((task,), timeout=max(deadline - self.loop.time(), 0))
+            if not task.done():
+                # Waiting out a reconnect backoff, or the socket didn't go away in time
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+        join = self.loop.create_task(self._dispatcher.join())
+        await asyncio.wait((join,), timeout=max(deadline - self.loop.time(), 0))
+        if not join.done():
+            join.cancel()
+            _log.warning('[%s] dispatch: %d events still queued at the shutdown deadline', self.id, self._dispatcher.depth)
+
+        self.save_session()
+        await self._dispatcher.close()
+
     async def connect(self):
         backoff = ExponentialBackoff()
+        self._dispatcher.start()
+        self._connect_task = asyncio.current_task()
 
         ws_params = {
             'initial': True,
+            **self.load_session()
         }
-        while not self._reconnects == self.max_reconnects:
+        while not self._closed and not self._reconnects == self.max_reconnects:
             # Run forever untill max reconnects
-            ws = DiscordWebsocket(client=self,loop = self.loop, params=ws_params)
+            ws = DiscordWebsocket(client=self, loop=self.loop, **ws_params)
+            self.ws = ws
+            resume = True
+
+            try:
+                async with websockets.connect(ws.uri, **self._ws_client_params) as sock:
+                    ws._socket = sock
+                    self._reading = True
+                    while True:
+                        try:
+                            await ws.poll_event(sock) 
+                        except ReconnectWebSocket as e:
+                            _log.debug('[%s] gateway: got a request to %s', self.id, e.op.lower())
+                            resume = e.resume
+                            if resume:
+                                # Leaving the block closes with 1000 and discord drops the session on that
+                                await ws.close()
+                            break # We exit the main dataflow and create a new connection
+
+            except websockets.ConnectionClosed as e:
+                if self._closed:
+                    return None
+
+                code = e.rcvd.code if e.rcvd is not None else None
+                if code in FATAL_CLOSE_CODES:
+                    _log.error('[%s] gateway: closed with %s, not reconnecting', self.id, code)
+                    return None
+
+                resume = code not in SESSION_CLOSE_CODES
+                _log.info('[%s] gateway: closed with %s, will %s', self.id, code, 'resume' if resume else 'identify')
+
+            except OSError as e:
+                _log.warning('[%s] gateway: connection failed: %s', self.id, e)
+
+            except (websockets.InvalidHandshake, asyncio.TimeoutError) as e:
+                # A 429/5xx from the gateway or a resume_gateway_url that went away, back off like any other failure
+                _log.warning('[%s] gateway: handshake with %s failed: %s', self.id, ws.uri, e)
+                if ws.resume_set and ws.resume_url:
+                    # The session may still be good, resume through the main gateway
+                    ws.resume_url = None
 
-            async with websockets.connect(ws.uri, **self._ws_client_params) as sock:
-                while True:
-                    try:
-                        await ws.poll_event(sock) 
-                    except ReconnectWebSocket as e:
-                        _log.debug('[{}] gateway: got a request to {}'.format(self.id, e.op.lower()))
-                        ws_params.update(sequence=ws.sequence, resume=e.resume, session=ws.session_id)
-                        break # We exit the main dataflow and create a new connection
+            finally:
+                self._reading = False
+                if ws._keep_alive:
+                    ws._keep_alive.open = False
 
-                self._reconnects+=1
-                retry = backoff.delay()
+            if self._closed:
+                # close() stopped us, the session stays as it is for save_session()
+                return None
 
-                _log.info("Attempting a reconnect in %.2fs", retry)
-                await asyncio.sleep(retry)
+            # Whatever the old connection learned carries over, the next one resumes if it can
+            ws_params.update(
+                sequence=ws.sequence,
+                session_id=ws.session_id if resume else None,
+                resume_url=ws.resume_url,
+                resume=resume
+            )
+
+            # A connection that got to READY or RESUMED was healthy, only count failures in a row
+            if ws.established:
+                self._reconnects = 0
+                backoff = ExponentialBackoff()
+            self._reconnects+=1
+            self._m_reconnects.inc()
+            retry = backoff.delay()
+
+            _log.info("Attempting a reconnect in %.2fs", retry)
+            await asyncio.sleep(retry)
 
     def event(self, coro):
         setattr(self, coro.__name__, coro)
+        self._dispatcher.invalidate()
         _log.debug('%s has successfully been registered as an event', coro.__name__)    
     
     @property
@@ -99,5 +257,22 @@ class Client:
 
     @property
     def users(self):
-        return list(self._connection.users.values())
+        return list(self._connection._users.values())
+
+    @property
+    def latency(self):
+        keep_alive = self.ws._keep_alive if self.ws is not None else None
+        return keep_alive.latency if keep_alive is not None else float('inf')
+
+    def memory_report(self):
+        return self._connection.memory_report()
+
+    def stats(self):
+        return {
+            'id': self.id,
+            'latency': self.latency,
+            'reconnects': self._reconnects,
+            'dispatch': self._dispatcher.stats(),
+            'metrics': self.metrics.snapshot(client=self.id)
+        }
 
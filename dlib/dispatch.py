@@ -0,0 +1,200 @@
+import time
+import asyncio
+import logging
+
+_log = logging.getLogger(__name__)
+
+# What to do with an event when the queue is full
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+SPILL = 'spill'
+
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+class EventDispatcher:
+
+    def __init__(self, client, workers = 4, max_queue = 1000, overflow = BLOCK, batch_size = 100, batch_age = 0.5):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of {}'.format(', '.join(OVERFLOW_POLICIES)))
+
+        self.client = client
+        self.id = client.id
+        self.workers = workers
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.batch_age = batch_age
+
+        self._queue = asyncio.Queue()
+        self._space = asyncio.Event()
+        self._workers = []
+        self._spilled = set()
+
+        # Resolved on_ handlers, None when the client doesn't handle the event
+        self._handlers = {}
+        self._batches = {}
+        self._batch_timers = {}
+
+        # Metric data
+        self.dispatched = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.errors = 0
+        self.handled = 0
+        self.handler_time = 0.0
+        self.last_handler_latency = 0.0
+        self.max_handler_latency = 0.0
+
+        self._profiler = client.profiler
+
+        metrics = client.metrics
+        metrics.gauge('dlib_dispatch_queue_depth', 'Events waiting for a worker', func=self._queue.qsize, client=self.id)
+        self._m_handler = metrics.histogram('dlib_dispatch_handler_seconds', 'Event handler run time', client=self.id)
+        self._m_dropped = metrics.counter('dlib_dispatch_dropped_total', 'Events dropped on overflow', client=self.id)
+        self._m_spilled = metrics.counter('dlib_dispatch_spilled_total', 'Events spilled out of the pool', client=self.id)
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    @property
+    def saturated(self):
+        return self.overflow == BLOCK and self._queue.qsize() >= self.max_queue
+
+    def stats(self):
+        return {
+            'depth': self._queue.qsize(),
+            'dispatched': self.dispatched,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'errors': self.errors,
+            'handled': self.handled,
+            'handler_time': self.handler_time,
+            'last_handler_latency': self.last_handler_latency,
+            'max_handler_latency': self.max_handler_latency
+        }
+
+    def start(self):
+        for i in range(self.workers - len(self._workers)):
+            name = 'dispatch-{}-{}'.format(self.id, len(self._workers))
+            self._workers.append(asyncio.create_task(self._worker(), name = name))
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions = True)
+        self._workers = []
+
+    def invalidate(self):
+        # Called when handlers change on the client
+        self._handlers.clear()
+
+    def handler(self, name):
+        try:
+            return self._handlers[name]
+        except KeyError:
+            handler = self._handlers[name] = getattr(self.client, name, None)
+            return handler
+
+    def dispatch(self, event, *args, **kwargs):
+        self.dispatched += 1
+
+        batch_handler = self.handler('on_{}_batch'.format(event))
+        if batch_handler is not None:
+            self._add_to_batch(event, batch_handler, args[0])
+
+        handler = self.handler('on_{}'.format(event))
+        if handler is not None:
+            self._enqueue((handler, args, kwargs))
+
+    def _add_to_batch(self, event, handler, item):
+        try:
+            batch = self._batches[event]
+        except KeyError:
+            batch = self._batches[event] = []
+            loop = asyncio.get_running_loop()
+            self._batch_timers[event] = loop.call_later(self.batch_age, self._flush_batch, event, handler)
+
+        batch.append(item)
+        if len(batch) >= self.batch_size:
+            self._batch_timers[event].cancel()
+            self._flush_batch(event, handler)
+
+    def _flush_batch(self, event, handler):
+        batch = self._batches.pop(event, None)
+        self._batch_timers.pop(event, None)
+        if batch:
+            self._enqueue((handler, (batch,), {}))
+
+    def _enqueue(self, item):
+        if not self._workers:
+            self.start()
+
+        if self._queue.qsize() >= self.max_queue:
+            if self.overflow == DROP_OLDEST:
+                self._queue.get_nowait()
+                self._queue.task_done()
+                self.dropped += 1
+                self._m_dropped.inc()
+
+            elif self.overflow == SPILL:
+                # Run it outside the pool like a plain task, we only keep a reference
+                self.spilled += 1
+                self._m_spilled.inc()
+                task = asyncio.create_task(self._invoke(*item))
+                self._spilled.add(task)
+                task.add_done_callback(self._spilled.discard)
+                return None
+
+            # With BLOCK we take it anyway, the gateway waits on wait_for_space()
+
+        self._queue.put_nowait(item)
+
+    async def wait_for_space(self):
+        while self._queue.qsize() >= self.max_queue:
+            self._space.clear()
+            await self._space.wait()
+
+    def flush_batches(self):
+        # Hand out partial batches now instead of waiting for their timers
+        for event in list(self._batches):
+            self._batch_timers[event].cancel()
+            self._flush_batch(event, self.handler('on_{}_batch'.format(event)))
+
+    async def join(self):
+        self.flush_batches()
+        await self._queue.join()
+        if self._spilled:
+            await asyncio.gather(*self._spilled, return_exceptions = True)
+
+    async def _invoke(self, handler, args, kwargs):
+        start = time.perf_counter()
+        try:
+            await handler(*args, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.errors += 1
+            _log.exception('[%s] dispatch: %s raised an exception', self.id, handler.__name__)
+        finally:
+            latency = time.perf_counter() - start
+            self.handled += 1
+            self.handler_time += latency
+            self.last_handler_latency = latency
+            self._m_handler.observe(latency)
+            if self._profiler.enabled:
+                self._profiler.record_sampled(handler.__name__, latency)
+            if latency > self.max_handler_latency:
+                self.max_handler_latency = latency
+
+    async def _worker(self):
+        queue = self._queue
+        while True:
+            item = await queue.get()
+            if queue.qsize() < self.max_queue:
+                self._space.set()
+
+            try:
+                await self._invoke(*item)
+            finally:
+                queue.task_done()
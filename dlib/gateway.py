@@ -1,16 +1,38 @@
-import zlib
 import time
 import random
 import logging
 import asyncio
 import datetime
 import threading
+import msgspec
 import websockets
 
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+
 from .utils import minutes_elapsed_timestamp, to_json, from_json
+from .inflate import ZlibStreamInflater
 
 _log = logging.getLogger(__name__)
 
+class GatewayPayload(msgspec.Struct):
+    # Only the envelope is decoded up front, d stays raw json until we know we want it
+    op: int
+    d: msgspec.Raw = msgspec.Raw()
+    s: Optional[int] = None
+    t: Optional[str] = None
+
+decode_payload = msgspec.json.Decoder(GatewayPayload).decode
+
+# zlib and msgspec both release the GIL, a couple of threads are enough for every connection
+_offload_executor = None
+
+def offload_executor():
+    global _offload_executor
+    if _offload_executor is None:
+        _offload_executor = ThreadPoolExecutor(max_workers = 2, thread_name_prefix = 'dlib_offload')
+    return _offload_executor
+
 class ReconnectWebSocket(Exception):
     
     def __init__(self, resume = True):
@@ -43,15 +65,21 @@ class AsyncKeepaliveHandler:
         ack_time = time.perf_counter()
         self._last_ack = ack_time
         self.latency = ack_time - self._last_send
+        self.websocket._m_heartbeat.observe(self.latency)
 
         if self.latency > 10:
-            _log.warn(self.behind_msg % (self.websocket.id, self.latency))
+            _log.warning(self.behind_msg, self.id, self.latency)
         else:
-            _log.debug(self.msg % (self.id, self.websocket.sequence))
+            _log.debug(self.msg, self.id, self.websocket.sequence)
 
     def tick(self):
         self._last_recv = time.perf_counter()
 
+    async def send_heartbeat(self):
+        # The gateway asked for one out of schedule
+        await self.socket.send(to_json(self.get_payload()))
+        self._last_send = time.perf_counter()
+
     def get_payload(self):
         return {
             'op': self.websocket.HEARTBEAT,
@@ -63,7 +91,8 @@ class AsyncKeepaliveHandler:
 
         while self.open:
             if self._last_recv + self.heartbeat_timeout < time.perf_counter():
-                _log.warn('[{}] keepalive: has stopped responding to gateway, closing'.format(self.id))
+                _log.warning('[%s] keepalive: has stopped responding to gateway, closing', self.id)
+                self.websocket.close_from_keep_alive()
                 return None
 
             data = self.get_payload()
@@ -74,11 +103,15 @@ class AsyncKeepaliveHandler:
                 self._last_send = time.perf_counter()
 
             except asyncio.exceptions.TimeoutError:
-                _log.warn('[{}] keepalive: error, closing connection'.format(self.id))
+                _log.warning('[%s] keepalive: error, closing connection', self.id)
 
                 # We can't really close it in here since we need to raise an exception
                 self.websocket.close_from_keep_alive()
                 return None
+
+            except websockets.ConnectionClosed:
+                # The connection went away between two heartbeats, connect() takes it from here
+                return None
             
             await asyncio.sleep(self.interval - self.WINDOW)
 
@@ -101,51 +134,120 @@ class DiscordWebsocket:
         self.loop = loop
         self.id = client.id
         self.token = client.token
-        self.uri = 'wss://gateway.discord.gg/?encoding=json&v=9&compress=zlib-stream'
+        self.uri = '{}/?encoding=json&v=9&compress=zlib-stream'.format(client.gateway_url.rstrip('/'))
+        self._socket = None
             
         self._connection = client._connection
         self._discord_parsers = client._connection.parsers
         self._dispatch = client.dispatch
+        self._raw_events = client.raw_events
+        self._offload_threshold = client.offload_threshold
+        self._dispatcher = client._dispatcher
+        self._profiler = client.profiler
         self._device = client._device
 
         # ws related stuff
         self._keep_alive = None
 
-        # Updatables
+        # Updatables, carried over from the previous connection so we can resume
         self.session_id = params.get('session_id', None)
-        self.sequence = params.get('session_id', None)
-        self.resume_set = params.get('resume', False)
+        self.sequence = params.get('sequence', None)
+        self.resume_url = params.get('resume_url', None)
+        self.resume_set = params.get('resume', False) and self.session_id is not None and self.sequence is not None
+        # Set once READY or RESUMED arrived on this connection
+        self.established = False
+
+        # Resumes go to the gateway that handed out the session
+        if self.resume_set and self.resume_url:
+            self.uri = '{}/?encoding=json&v=9&compress=zlib-stream'.format(self.resume_url.rstrip('/'))
+
+        # Events the gateway replays between our RESUME and its RESUMED
+        self._resuming = False
+        self._replayed = 0
 
         self._max_heartbeat_timeout = client._connection.heartbeat_timeout
-        self._zlib = zlib.decompressobj()
-        self._buffer = bytearray()
+        self._inflater = ZlibStreamInflater()
         self._close_code = None
 
+        # Metrics are shared with earlier connections of the same client
+        metrics = client.metrics
+        self._metrics = metrics
+        self._m_frames = metrics.counter('dlib_gateway_frames_total', 'Binary frames received', client=self.id)
+        self._m_bytes = metrics.counter('dlib_gateway_received_bytes_total', 'Compressed bytes received', client=self.id)
+        self._m_inflated = metrics.counter('dlib_gateway_inflated_bytes_total', 'Bytes after inflating', client=self.id)
+        self._m_inflate = metrics.histogram('dlib_gateway_inflate_seconds', 'Time spent inflating a message', client=self.id)
+        self._m_decode = metrics.histogram('dlib_gateway_decode_seconds', 'Time spent decoding the envelope', client=self.id)
+        self._m_heartbeat = metrics.histogram('dlib_gateway_heartbeat_latency_seconds', 'Heartbeat to ack latency', client=self.id)
+        self._m_identifies = metrics.counter('dlib_gateway_identifies_total', 'IDENTIFY sent, each one costs a READY', client=self.id)
+        self._m_resumes = metrics.counter('dlib_gateway_resumes_total', 'RESUME sent', client=self.id)
+        self._m_resumed = metrics.counter('dlib_gateway_resumed_total', 'Sessions successfully resumed', client=self.id)
+        self._m_resume_failed = metrics.counter('dlib_gateway_resume_failed_total', 'Resumes the gateway refused', client=self.id)
+        self._m_replayed = metrics.counter('dlib_gateway_replayed_events_total', 'Events replayed while resuming', client=self.id)
+        self._m_offloaded = metrics.counter('dlib_gateway_offloaded_frames_total', 'Messages inflated and decoded off the loop', client=self.id)
+        self._m_offload_saved = metrics.counter('dlib_gateway_offload_saved_seconds_total', 'Inflate and decode time spent in the offload threads', client=self.id)
+        self._m_events = {}
+
+    def _event_metrics(self, event):
+        try:
+            return self._m_events[event]
+        except KeyError:
+            metrics = self._m_events[event] = (
+                self._metrics.counter('dlib_gateway_events_total', 'Dispatch events received', client=self.id, event=event),
+                self._metrics.histogram('dlib_state_parser_seconds', 'Payload decode and parser time', client=self.id, event=event)
+            )
+            return metrics
+
     def clean(self):
         # Clean up after ourselfs
         self._keep_alive = None
         self.session_id = None
         self.sequence = None
-        self._zlib = bytearray()
-        self._buffer = bytearray()
+        self._inflater = ZlibStreamInflater()
         self._close_code = None
 
+    def _inflate_and_decode(self):
+        # Runs in the offload pool, received_message waits for it so events stay in order
+        start = time.perf_counter()
+        msg = self._inflater.inflate()
+        inflated = len(msg)
+        msg = decode_payload(msg)
+
+        data = None
+        if msg.d and (msg.op != self.DISPATCH or msg.t in self._discord_parsers or msg.t in self._raw_events):
+            data = from_json(msg.d)
+        return msg, data, inflated, time.perf_counter() - start
+
     async def received_message(self, socket, msg):
+        # Only set when the payload was already decoded off the loop
+        data = None
+
         if type(msg) is bytes:
-            self._buffer.extend(msg)
-            if len(msg) < 4 or msg[-4:] != b'\x00\x00\xff\xff':
-                return None
+            self._m_frames.inc()
+            self._m_bytes.inc(len(msg))
 
-            msg = self._zlib.decompress(self._buffer)
-            self._buffer = bytearray()
-        
-        msg = from_json(msg)
-        
-        event = msg['t'] if 't' in msg.keys() else None
+            size = self._inflater.push(msg)
+            if size is None:
+                return None
 
-        op = msg['op'] if 'op' in msg.keys() else None
-        data = msg['d'] if 'd' in msg.keys() else None
-        seq = msg['s'] if 's' in msg.keys() else None
+            if self._offload_threshold and size >= self._offload_threshold:
+                msg, data, inflated, elapsed = await self.loop.run_in_executor(offload_executor(), self._inflate_and_decode)
+                self._m_inflated.inc(inflated)
+                self._m_offloaded.inc()
+                self._m_offload_saved.inc(elapsed)
+                _log.debug('[%s] gateway: offloaded %d byte message, %.1fms off the loop', self.id, size, elapsed * 1000)
+            else:
+                msg = self._inflater.inflate()
+                self._m_inflated.inc(len(msg))
+                self._m_inflate.observe(self._inflater.last_inflate_time)
+
+        if type(msg) is not GatewayPayload:
+            start = time.perf_counter()
+            msg = decode_payload(msg)
+            self._m_decode.observe(time.perf_counter() - start)
+
+        op = msg.op
+        event = msg.t
+        seq = msg.s
         
         if seq is not None:
             self.sequence = seq
@@ -154,8 +256,11 @@ class DiscordWebsocket:
             self._keep_alive.tick()
  
         if op != self.DISPATCH:
+            if data is None and msg.d:
+                data = from_json(msg.d)
+
             if op == self.RECONNECT:
-                _log.debug('[{}] gateway: Asked for reconnect'.format(self.id))
+                _log.debug('[%s] gateway: Asked for reconnect', self.id)
                 self._keep_alive.open = False
                 raise ReconnectWebSocket()
 
@@ -165,34 +270,40 @@ class DiscordWebsocket:
                 return None
 
             if op == self.HEARTBEAT:
-                await self._keep_alive.send_heartbeat(self.id)    
-                _log.debug('[{}] gateway: Request forcefull hearbeat send'.format(self.id))
+                if self._keep_alive:
+                    await self._keep_alive.send_heartbeat()
+                _log.debug('[%s] gateway: Request forcefull hearbeat send', self.id)
                 return None
             
             if op == self.HELLO:
                 interval = data['heartbeat_interval'] / 1000.0
+                self._socket = socket
                 
                 if not self.resume_set:
                     # Send identify
                     await self.identify(socket)
                 else:
-                    await ws.resume()
+                    await self.resume(socket)
                  
                 self._keep_alive = AsyncKeepaliveHandler(websocket=self, interval=interval, socket=socket)
                 self.loop.create_task(self._keep_alive.run())
             
             if op == self.INVALIDATE_SESSION:
+                if self._keep_alive:
+                    self._keep_alive.open = False
+
+                if self._resuming:
+                    self._m_resume_failed.inc()
+
                 if data is True:
                     raise ReconnectWebSocket()
                     
                 # Set to null
                 self.sequence = None
                 self.session_id = None
-                
-                # Close keepalive
-                self._keep_alive.open = False
+                self.resume_url = None
 
-                _log.info('[{}] gateway: Invalidated session'.format(self.id))
+                _log.info('[%s] gateway: Invalidated session', self.id)
                 raise ReconnectWebSocket(resume=False)
             
             # End of op processing
@@ -200,26 +311,58 @@ class DiscordWebsocket:
  
         if event == 'READY':
             # Update our prescence as we connect
+            self.established = True
             await self.change_presence(socket)
 
         elif event == 'RESUMED':
-            _log.debug('[{}] gateway: has resumed'.format(self.id))
+            self.established = True
+            self._resuming = False
+            self._m_resumed.inc()
+            _log.info('[%s] gateway: resumed session at sequence=%s, %d events replayed',
+                self.id, self.sequence, self._replayed)
+
+        elif self._resuming:
+            self._replayed += 1
+            self._m_replayed.inc()
+
+        events, parser_time = self._event_metrics(event)
+        events.inc()
 
         try:
             func = self._discord_parsers[event]
         except KeyError:
-            if event is not None:
-                _log.debug('[{}] gateway: unsubscribed event seq={}, event={}'.format(self.id, seq, event)) 
+            if event in self._raw_events:
+                self._dispatch('raw_{}'.format(event.lower()), data if data is not None else from_json(msg.d))
+            elif event is not None:
+                # Dropped without ever decoding the payload
+                _log.debug('[%s] gateway: unsubscribed event seq=%s, event=%s', self.id, seq, event)
         else:
-            func(data)
+            start = time.perf_counter()
+            func(data if data is not None else from_json(msg.d))
+            elapsed = time.perf_counter() - start
+            parser_time.observe(elapsed)
+
+            if self._profiler.enabled:
+                self._profiler.record_sampled(func.__name__, elapsed)
+
+            if event == 'READY':
+                # parse_ready keeps the session, we need it to resume later
+                self.session_id = self._connection.session_id
+                self.resume_url = self._connection.resume_url
+
+            # Stop reading from the socket while the handlers catch up
+            if self._dispatcher.saturated:
+                await self._dispatcher.wait_for_space()
+
+    async def close(self, code = 4000):
+        # Anything but 1000/1001 leaves the session open on discord's side so it can be resumed
+        if self._socket is not None:
+            await self._socket.close(code=code)
 
     def close_from_keep_alive(self):
-        # Yeah i can't care more anymore.
-        try:
-            raise ReconnectWebSocket()
-        # Funny we are raising anod now we need to close
-        except ReconnectWebSocket:
-            pass
+        # Anything but 1000/1001 keeps the session resumable, poll_event sees the close and we reconnect
+        if self._socket is not None:
+            self.loop.create_task(self._socket.close(code=4000))
 
     async def change_presence(self, socket):
         # Create an elapsed timestamp for exmaple "20-60 minutes"
@@ -244,7 +387,7 @@ class DiscordWebsocket:
         }
         await socket.send(to_json(payload))
 
-    async def resume(self):
+    async def resume(self, socket):
         payload = {
             'op': self.RESUME,
             'd': {
@@ -253,7 +396,11 @@ class DiscordWebsocket:
                 'token': self.token
             }
         }
+        self._resuming = True
+        self._replayed = 0
+        self._m_resumes.inc()
         await socket.send(to_json(payload))
+        _log.debug('[%s] gateway: resuming session at sequence=%s', self.id, self.sequence)
 
     async def identify(self, socket):
         # This is highly unreliable
@@ -284,12 +431,28 @@ class DiscordWebsocket:
             'afk': False
         }
         
+        self._m_identifies.inc()
         await socket.send(to_json(payload))
 
+    def _hello_timeout(self, sock):
+        _log.warning('[%s] gateway: no HELLO after %.0fs, closing', self.id, self._max_heartbeat_timeout)
+        self.loop.create_task(sock.close(code=4000))
+
     async def poll_event(self, sock):
-        try:
-            msg = await asyncio.wait_for(sock.recv(), timeout = self._max_heartbeat_timeout)
-            await self.received_message(sock, msg)
+        # No wait_for here, on 3.10/3.11 it can swallow a cancel that races a message
+        if self._keep_alive is None:
+            # Until HELLO starts the keepalive nothing else closes a socket that went silent
+            timer = self.loop.call_later(self._max_heartbeat_timeout, self._hello_timeout, sock)
+            try:
+                msg = await sock.recv()
+            finally:
+                timer.cancel()
+        else:
+            msg = await sock.recv()
 
-        except asyncio.exceptions.TimeoutError as e:
-            _log.error('[{}] gateway: receive timeout'.format(self.id))
+        if self._profiler.enabled and self._profiler.sample():
+            start = time.perf_counter()
+            await self.received_message(sock, msg)
+            self._profiler.record('received_message', time.perf_counter() - start)
+        else:
+            await self.received_message(sock, msg)
@@ -1,4 +1,8 @@
 from .channel import TextChannel
+from .store import intern_string
+
+# Text and announcement channels, both carry messages and share a payload
+TEXT_CHANNEL_TYPES = (0, 5)
 
 def factory_channel(channel_type, channel):
     if channel_type == 0:
@@ -6,6 +10,22 @@ def factory_channel(channel_type, channel):
         return None
 
 class Guild:
+
+    __slots__ = (
+        'channels',
+        'members',
+        '_state',
+        'id',
+        'name',
+        'verification_level',
+        '_icon',
+        '_banner',
+        'emojis',
+        'description',
+        'vanity_url_code',
+        '_discovery_splash',
+        'owner_id'
+    )
     
     def __init__(self, state, data):
         self.channels = {}
@@ -14,22 +34,34 @@ class Guild:
         
         # Data
         self.id = int(data['id'])
-        self.name = data['name']
+        self._update(data)
+    
+        # The only channel types we care about are (0, 2, 4, 5, 11, 13, 14, 15)
+        for channel_data in data['channels']:
+            self._add_channel(channel_data)
+
+    def _update(self, data):
+        # GUILD_UPDATE sends the same fields minus the channels
+        self.name = intern_string(data['name'])
         self.verification_level = int(data['verification_level'])
         self._icon = data['icon']
         self._banner = data['banner']
-        self.emojis = data['emojis']
+        # Only the ids, the raw emoji objects are never used
+        self.emojis = tuple(int(emoji['id']) for emoji in data['emojis'])
         self.description = data['description']
         self.vanity_url_code = data['vanity_url_code']
         self._discovery_splash = data['discovery_splash']
         self.owner_id = int(data['owner_id'])
-    
-        # The only channel types we care about are (0, 2, 4, 5, 11, 13, 14, 15)
-        for channel_data in data['channels']:
-            if channel_data['type'] == 0:
-                channel = TextChannel(state, self, channel_data)
-                # Fast lookups
-                self.channels[channel.id] = channel
+
+    def _add_channel(self, data):
+        # Returns None for channel types we don't keep
+        if data['type'] not in TEXT_CHANNEL_TYPES:
+            return None
+
+        channel = TextChannel(self._state, self, data)
+        # Fast lookups
+        self.channels[channel.id] = channel
+        return channel
 
     def __str__(self):
         return self.name
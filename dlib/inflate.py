@@ -0,0 +1,93 @@
+import zlib
+import time
+
+ZLIB_SUFFIX = b'\x00\x00\xff\xff'
+
+class ZlibStreamInflater:
+    # Keep a buffer around for multi frame messages instead of reallocating one per message
+    BUFFER_SIZE = 64 * 1024
+    MAX_RETAINED = 1024 * 1024
+
+    def __init__(self):
+        self._zlib = zlib.decompressobj()
+        self._buffer = bytearray(self.BUFFER_SIZE)
+        self._length = 0
+        self._frame = None
+
+        # Metric data
+        self.frames = 0
+        self.messages = 0
+        self.compressed_bytes = 0
+        self.decompressed_bytes = 0
+        self.inflate_time = 0.0
+        self.last_inflate_time = 0.0
+        self.max_inflate_time = 0.0
+
+    def _append(self, frame):
+        end = self._length + len(frame)
+        if end > len(self._buffer):
+            # Grow to the next power of two so a run of large frames settles quickly
+            self._buffer.extend(bytes((1 << (end - 1).bit_length()) - len(self._buffer)))
+
+        self._buffer[self._length:end] = frame
+        self._length = end
+
+    def push(self, frame):
+        # Returns the compressed size once the last frame of a message arrived, None until then
+        self.frames += 1
+        self.compressed_bytes += len(frame)
+
+        complete = frame[-4:] == ZLIB_SUFFIX
+        if not complete or self._length:
+            self._append(frame)
+            return self._length if complete else None
+
+        # Single frame message, inflate straight from the frame
+        self._frame = frame
+        return len(frame)
+
+    def inflate(self):
+        # Inflates the message push() completed, fine to run in another thread while nothing else is pushed
+        if self._frame is not None:
+            data, self._frame = self._frame, None
+        else:
+            data = memoryview(self._buffer)[:self._length]
+
+        start = time.perf_counter()
+        try:
+            msg = self._zlib.decompress(data)
+        finally:
+            if self._length:
+                data.release()
+                self._length = 0
+
+                # Don't hold on to the memory of an oversized READY forever
+                if len(self._buffer) > self.MAX_RETAINED:
+                    self._buffer = bytearray(self.BUFFER_SIZE)
+
+        elapsed = time.perf_counter() - start
+        self.messages += 1
+        self.decompressed_bytes += len(msg)
+        self.inflate_time += elapsed
+        self.last_inflate_time = elapsed
+        if elapsed > self.max_inflate_time:
+            self.max_inflate_time = elapsed
+
+        return memoryview(msg)
+
+    def feed(self, frame):
+        # Returns a memoryview of the inflated message or None when the message isn't complete
+        if self.push(frame) is None:
+            return None
+        return self.inflate()
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'messages': self.messages,
+            'compressed_bytes': self.compressed_bytes,
+            'decompressed_bytes': self.decompressed_bytes,
+            'inflate_time': self.inflate_time,
+            'last_inflate_time': self.last_inflate_time,
+            'max_inflate_time': self.max_inflate_time
+        }
@@ -0,0 +1,85 @@
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+from .metrics import REGISTRY
+
+FORMAT = '[%(asctime)s][%(levelname)s] %(name)s - %(message)s'
+
+class RateLimitFilter(logging.Filter):
+    # At most burst records per message template every period seconds, the rest are counted and summarised later
+
+    def __init__(self, period = 10.0, burst = 5, level = logging.WARNING):
+        super().__init__()
+        self.period = period
+        self.burst = burst
+        self.level = level
+        # (logger, level, template) -> [window start, records in window, suppressed in window]
+        self._windows = {}
+        self._m_suppressed = REGISTRY.counter('dlib_log_suppressed_total', 'Log records dropped by the rate limiter')
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        window = self._windows.get(key)
+
+        if window is None or now - window[0] >= self.period:
+            suppressed = window[2] if window is not None else 0
+            self._windows[key] = [now, 1, 0]
+            if suppressed and isinstance(record.msg, str):
+                record.msg = record.msg + ' ({} similar suppressed)'.format(suppressed)
+            return True
+
+        window[1] += 1
+        if window[1] <= self.burst:
+            return True
+
+        window[2] += 1
+        self._m_suppressed.inc()
+        return False
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    # Never blocks the caller, a full queue drops the record instead
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self._m_dropped = REGISTRY.counter('dlib_log_dropped_total', 'Log records dropped because the queue was full')
+
+    def prepare(self, record):
+        # The listener runs in our process, leave the formatting to its thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._m_dropped.inc()
+
+def setup_logging(level = logging.INFO, names = ('dlib',), handlers = None, fmt = FORMAT,
+                  max_queue = 10000, period = 10.0, burst = 5):
+    # Callers only pay for a filter check and a put, a listener thread does the formatting and writing
+    if handlers is None:
+        handlers = [logging.StreamHandler()]
+    for handler in handlers:
+        if handler.formatter is None:
+            handler.setFormatter(logging.Formatter(fmt))
+
+    records = queue.Queue(maxsize = max_queue)
+    handler = AsyncQueueHandler(records)
+    handler.addFilter(RateLimitFilter(period = period, burst = burst))
+
+    for name in names:
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.addHandler(handler)
+
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level = True)
+    listener.start()
+    # Flush whatever is queued when the process exits
+    atexit.register(listener.stop)
+    return listener
@@ -1,5 +1,4 @@
 from .utils import snowflake_time
-from .user import User
 
 class MessageReference:
 
@@ -9,7 +8,7 @@ class MessageReference:
 
 class Message:
 
-    __slots__ = ('_state', 'channel', 'id', 'type', 'everyone', 'author', 'created_at', 'content')
+    __slots__ = ('_state', 'channel', 'id', 'type', 'everyone', 'author', '_created_at', 'content')
 
     def __init__(self, state, channel, data):
         self._state = state
@@ -17,7 +16,32 @@ class Message:
         self.id = int(data['id'])
         self.type = int(data['type'])
         self.everyone = data['mention_everyone']
-        self.author = User(state=state, data=data['author'])
-        self.created_at = snowflake_time(self.id)
+        # Most authors are already cached, only build a user when we have to
+        self.author = state.store_user(data['author'])
+        self._created_at = None
         self.content = data['content']
 
+    @property
+    def created_at(self):
+        if self._created_at is None:
+            self._created_at = snowflake_time(self.id)
+        return self._created_at
+
+    @property
+    def record(self):
+        # Row form for storage sinks, matches the messages table column order
+        return (self.id, self.channel.id, self.author.id, self.type, self.everyone, self.content)
+
+    def _copy(self):
+        message = self.__class__.__new__(self.__class__)
+        for name in self.__slots__:
+            setattr(message, name, getattr(self, name))
+        return message
+
+    def _update(self, data):
+        # MESSAGE_UPDATE payloads are partial, embed resolves come without content
+        if 'content' in data:
+            self.content = data['content']
+        if 'mention_everyone' in data:
+            self.everyone = data['mention_everyone']
+
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+
+from bisect import bisect_left
+
+_log = logging.getLogger(__name__)
+
+# Seconds, from a fast parse up to a stalled database
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+class Counter:
+    type = 'counter'
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+class Gauge:
+    type = 'gauge'
+    __slots__ = ('value', '_func')
+
+    def __init__(self, func = None):
+        self.value = 0
+        # Callback gauges read their value when collected, nothing to do on the hot path
+        self._func = func
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+    def dec(self, amount = 1):
+        self.value -= amount
+
+    def snapshot(self):
+        return self._func() if self._func is not None else self.value
+
+class Histogram:
+    type = 'histogram'
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last slot is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the quantile, good enough to spot tails
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.50),
+            'p99': self.quantile(0.99)
+        }
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._types = {}
+
+    def _get(self, cls, name, help, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        try:
+            return self._metrics[key]
+        except KeyError:
+            if self._types.setdefault(name, cls.type) != cls.type:
+                raise ValueError('{} is already registered as a {}'.format(name, self._types[name]))
+
+            metric = self._metrics[key] = cls(*args)
+            self._help.setdefault(name, help)
+            return metric
+
+    def counter(self, name, help = '', **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help = '', func = None, **labels):
+        gauge = self._get(Gauge, name, help, labels, func)
+        # A new owner of the series (a client that reconnected) takes over the callback
+        if func is not None:
+            gauge._func = func
+        return gauge
+
+    def histogram(self, name, help = '', buckets = DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def snapshot(self, **match):
+        # {name: [{'labels': {...}, 'value': ...}]}, optionally only the series matching the labels
+        result = {}
+        for (name, labels), metric in self._metrics.items():
+            labels = dict(labels)
+            if any(labels.get(key) != value for key, value in match.items()):
+                continue
+            result.setdefault(name, []).append({'labels': labels, 'value': metric.snapshot()})
+        return result
+
+    def render_prometheus(self):
+        lines = []
+        described = set()
+
+        for (name, labels), metric in sorted(self._metrics.items(), key = lambda item: item[0]):
+            if name not in described:
+                described.add(name)
+                if self._help.get(name):
+                    lines.append('# HELP {} {}'.format(name, self._help[name]))
+                lines.append('# TYPE {} {}'.format(name, metric.type))
+
+            if metric.type == 'histogram':
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), metric.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', le),)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), metric.sum))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), metric.count))
+            else:
+                lines.append('{}{} {}'.format(name, format_labels(labels), metric.snapshot()))
+
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+# Shared by every client in the process
+REGISTRY = Registry()
+
+class MetricsServer:
+    # Bare bones http endpoint for prometheus, every path returns the metrics
+
+    def __init__(self, registry = REGISTRY, host = '127.0.0.1', port = 9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        _log.info('metrics: serving prometheus metrics on %s:%s', self.host, self.port)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            # We don't care about the request, read the headers and answer
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout = 5.0)
+            body = self.registry.render_prometheus().encode()
+            writer.write(
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                b'Connection: close\r\n\r\n' + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,126 @@
+import time
+import signal
+import random
+import logging
+
+_log = logging.getLogger(__name__)
+
+class FunctionStats:
+    __slots__ = ('count', 'total', 'max', 'samples', '_seen')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+        self._seen = 0
+
+class Profiler:
+    # Off by default, the hot path only checks .enabled until someone switches it on
+
+    def __init__(self, sample_rate = 1.0, max_samples = 2048):
+        self.enabled = False
+        self.sample_rate = sample_rate
+        self.max_samples = max_samples
+        self._stats = {}
+        self._started = None
+
+        # Use our own random instance to avoid messing with global one
+        rand = random.Random()
+        rand.seed()
+        self._random = rand.random
+
+    def enable(self, sample_rate = None):
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        self._started = time.monotonic()
+        self.enabled = True
+        _log.info('profiler: enabled, sample rate %.2f', self.sample_rate)
+
+    def disable(self):
+        self.enabled = False
+        _log.info('profiler: disabled')
+
+    def toggle(self):
+        self.disable() if self.enabled else self.enable()
+
+    def reset(self):
+        self._stats = {}
+        self._started = time.monotonic()
+
+    def sample(self):
+        return self.sample_rate >= 1.0 or self._random() < self.sample_rate
+
+    def record(self, name, elapsed):
+        try:
+            stats = self._stats[name]
+        except KeyError:
+            stats = self._stats[name] = FunctionStats()
+
+        stats.count += 1
+        stats.total += elapsed
+        if elapsed > stats.max:
+            stats.max = elapsed
+
+        # Reservoir sampling keeps the tail estimate honest on long runs
+        stats._seen += 1
+        if len(stats.samples) < self.max_samples:
+            stats.samples.append(elapsed)
+        else:
+            index = int(self._random() * stats._seen)
+            if index < self.max_samples:
+                stats.samples[index] = elapsed
+
+    def record_sampled(self, name, elapsed):
+        if self.sample():
+            self.record(name, elapsed)
+
+    def report(self):
+        report = {}
+        for name, stats in self._stats.items():
+            samples = sorted(stats.samples)
+            report[name] = {
+                'count': stats.count,
+                'total': stats.total,
+                'mean': stats.total / stats.count,
+                'p50': samples[int(len(samples) * 0.50)],
+                'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+                'max': stats.max
+            }
+        return report
+
+    def format_report(self):
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        lines = ['profile over {:.1f}s, sample rate {:.2f}'.format(elapsed, self.sample_rate)]
+        lines.append('{:<40} {:>10} {:>12} {:>10} {:>10} {:>10}'.format(
+            'function', 'count', 'total ms', 'mean us', 'p99 us', 'max us'))
+
+        report = sorted(self.report().items(), key = lambda item: item[1]['total'], reverse = True)
+        for name, stats in report:
+            lines.append('{:<40} {:>10} {:>12.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                name,
+                stats['count'],
+                stats['total'] * 1e3,
+                stats['mean'] * 1e6,
+                stats['p99'] * 1e6,
+                stats['max'] * 1e6
+            ))
+        return '\n'.join(lines)
+
+    def dump(self, path = None):
+        text = self.format_report()
+        if path is None:
+            _log.info('profiler: %s', text)
+            return None
+
+        with open(path, 'a') as fp:
+            fp.write('[{}] {}\n\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), text))
+        _log.info('profiler: report written to %s', path)
+
+    def install(self, loop, path = None, dump_signal = signal.SIGUSR1, toggle_signal = signal.SIGUSR2):
+        # kill -USR2 switches profiling on and off, kill -USR1 dumps what we have
+        loop.add_signal_handler(dump_signal, self.dump, path)
+        loop.add_signal_handler(toggle_signal, self.toggle)
+
+# Shared by every client in the process
+PROFILER = Profiler()
@@ -1,26 +1,34 @@
+import sys
+import time
 import logging
 
 from .user import ClientUser, User
-from .channel import DMChannel, PrivateChannel
-from .guild import Guild
+from .channel import DMChannel, PrivateChannel, PartialChannel
+from .guild import Guild, TEXT_CHANNEL_TYPES
 from .message import Message
+from .store import LRUStore, MessageCache, estimate_size
 
 _log = logging.getLogger(__name__)
 
 class ConnectionState:
 
-    def __init__(self, loop, http, dispatch):
+    def __init__(self, loop, http, dispatch, max_users = 100000, max_messages = 1000):
         self.loop = loop
         self.http = http
         self.dispatch = dispatch
-        self.max_messages = 1000
+        self.max_messages = max_messages
         # Set the abs() max heartbeat timeout
         self.heartbeat_timeout = 60.0
+        self.session_id = None
+        self.resume_url = None
 
-        # Storing
-        self._users = {}
+        # Storing, users are the only cache that grows with the traffic
+        self._users = LRUStore(max_size = max_users)
         self._guilds = {}
+        # Raw READY guilds, turned into a Guild the first time something needs them
+        self._guild_data = {}
         self._channels = {}
+        self._messages = MessageCache(max_size = max_messages) if max_messages else None
 
         self.parsers = parsers = {}
         for attr in dir(self):
@@ -31,15 +39,53 @@ class ConnectionState:
     def clear(self):
         pass
 
+    def memory_report(self):
+        # Rough estimate in bytes, walks every cached object so don't call it on the hot path
+        users = sum(estimate_size(user) for user in self._users.values())
+        guilds = sum(estimate_size(guild) for guild in self._guilds.values())
+        guild_channels = sum(
+            estimate_size(channel)
+            for guild in self._guilds.values()
+            for channel in guild.channels.values()
+        )
+        channels = sum(estimate_size(channel) for channel in self._channels.values())
+        messages = list(self._messages) if self._messages is not None else []
+
+        return {
+            'users': {
+                'count': len(self._users),
+                'max_size': self._users.max_size,
+                'evictions': self._users.evictions,
+                'bytes': users + sys.getsizeof(self._users)
+            },
+            'guilds': {
+                'count': len(self._guilds),
+                'pending': len(self._guild_data),
+                'bytes': guilds + guild_channels + sys.getsizeof(self._guilds)
+            },
+            'channels': {
+                'count': len(self._channels),
+                'bytes': channels + sys.getsizeof(self._channels)
+            },
+            'messages': {
+                'count': len(messages),
+                'max_size': self.max_messages,
+                'bytes': sum(estimate_size(message) for message in messages)
+            }
+        }
+
     def store_user(self, data):
         user_id = int(data['id'])
         try:
-            return self._users[user_id]
+            user = self._users[user_id]
         except KeyError:
             user = User(state=self, data=data)
             if user.discriminator != '0000':
                 self._users[user_id] = user
             return user
+        else:
+            user._update(data)
+            return user
 
     def store_guild(self, data):
         guild_id = int(data['id'])
@@ -50,21 +96,41 @@ class ConnectionState:
             self._guilds[guild_id] = guild
             return guild
 
+    def _get_guild(self, guild_id):
+        try:
+            return self._guilds[guild_id]
+        except KeyError:
+            # Raises KeyError for guilds we don't know about at all
+            data = self._guild_data.pop(guild_id)
+            return self.store_guild(data)
+
     def _get_guild_channel(self, data, guild_id = None):
         channel_id = int(data['channel_id'])
+        guild = None
         try:
             guild_id = guild_id or int(data['guild_id'])
-            guild = self._guilds[guild_id]
-            channel = guild.channels[channel_id]
-            #guild = self._get_guild(guild_id)
+            guild = self._get_guild(guild_id)
+            return guild.channels[channel_id], guild
 
         except KeyError:
-            channel = self._channels[channel_id]
-            guild = None
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                # Threads, channel types we don't keep or a create we missed, the message still counts
+                channel = PartialChannel(channel_id, guild)
 
         return channel, guild
 
+    def _channel_guild(self, data):
+        # None for guilds we have never seen
+        try:
+            return self._get_guild(int(data['guild_id']))
+        except KeyError:
+            return None
+
     def parse_ready(self, data):
+        start = time.perf_counter()
+        self.session_id = data['session_id']
+        self.resume_url = data.get('resume_gateway_url')
         self.user = ClientUser(state=self, data=data['user'])
 
         # add all the users
@@ -72,29 +138,146 @@ class ConnectionState:
         for user in data['users']:
             self.store_user(user)
 
+        # Building every guild up front blocks the loop on large accounts, defer it
         for guild_data in data['guilds']:
-            self.store_guild(guild_data)
+            guild_id = int(guild_data['id'])
+            if guild_id not in self._guilds:
+                self._guild_data[guild_id] = guild_data
 
+        # Recipients come from the payload, the store may have evicted them already
+        users = {int(user['id']): user for user in data['users']}
         for private_channel in data['private_channels']:
             channel_id = int(private_channel['id']) 
-            self._channels[channel_id] = PrivateChannel(me=self.user, state=self, data=private_channel)
+            self._channels[channel_id] = PrivateChannel(me=self.user, state=self, data=private_channel, users=users)
+
+        _log.info('[%s] ready: %d users, %d guilds (deferred), %d private channels in %.1fms',
+            self.id, len(data['users']), len(data['guilds']), len(data['private_channels']),
+            (time.perf_counter() - start) * 1000)
 
         self.dispatch('ready')
 
+    def parse_guild_create(self, data):
+        if data.get('unavailable'):
+            # Outage notice without the guild, whatever we have stays
+            return None
+
+        guild_id = int(data['id'])
+        known = self._guild_data.pop(guild_id, None) is not None or guild_id in self._guilds
+        guild = self._guilds[guild_id] = Guild(state=self, data=data)
+
+        # Back from an outage or a guild we just joined
+        self.dispatch('guild_available' if known else 'guild_join', guild)
+
+    def parse_guild_update(self, data):
+        guild_id = int(data['id'])
+        pending = self._guild_data.get(guild_id)
+        if pending is not None:
+            # Not built yet, patch the READY payload and stay lazy
+            pending.update((key, value) for key, value in data.items() if key != 'channels')
+            return None
+
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            _log.debug('[%s] guild update for unknown guild %s', self.id, guild_id)
+            return None
+
+        guild._update(data)
+        self.dispatch('guild_update', guild)
+
+    def parse_guild_delete(self, data):
+        if data.get('unavailable'):
+            # An outage, the guild comes back with a GUILD_CREATE
+            return None
+
+        guild_id = int(data['id'])
+        self._guild_data.pop(guild_id, None)
+        guild = self._guilds.pop(guild_id, None)
+        if guild is not None:
+            self.dispatch('guild_remove', guild)
+
+    def parse_channel_create(self, data):
+        if 'guild_id' not in data:
+            channel = PrivateChannel(me=self.user, state=self, data=data)
+            self._channels[channel.id] = channel
+        else:
+            guild = self._channel_guild(data)
+            channel = guild._add_channel(data) if guild is not None else None
+            if channel is None:
+                return None
+
+        self.dispatch('channel_create', channel)
+
+    def parse_channel_update(self, data):
+        channel_id = int(data['id'])
+        if 'guild_id' not in data:
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                return self.parse_channel_create(data)
+            channel._update(self, data)
+            return self.dispatch('channel_update', channel)
+
+        guild = self._channel_guild(data)
+        if guild is None:
+            return None
+
+        channel = guild.channels.get(channel_id)
+        if data['type'] not in TEXT_CHANNEL_TYPES:
+            # Converted to something we don't keep
+            if channel is not None:
+                del guild.channels[channel_id]
+                self.dispatch('channel_delete', channel)
+            return None
+
+        if channel is None:
+            # Missed the create or it was a type we didn't keep before
+            return self.parse_channel_create(data)
+
+        channel._update(data)
+        self.dispatch('channel_update', channel)
+
+    def parse_channel_delete(self, data):
+        channel_id = int(data['id'])
+        if 'guild_id' not in data:
+            channel = self._channels.pop(channel_id, None)
+        else:
+            guild = self._channel_guild(data)
+            channel = guild.channels.pop(channel_id, None) if guild is not None else None
+
+        if channel is not None:
+            self.dispatch('channel_delete', channel)
+
     def parse_message_create(self, data):
         channel, _ = self._get_guild_channel(data)
+
+        # Message stores the author for us, so look before it does
+        new_user = int(data['author']['id']) not in self._users
         message = Message(state=self, data=data, channel=channel)
 
-        user_id = message.author.id
+        if new_user:
+            _log.debug('[%s] new user: %s, %s', self.id, message.author.id, message.author)
+            self.dispatch('new_user', message.author)
 
+        if self._messages is not None:
+            self._messages.append(message)
 
-        if user_id not in self._users.keys():
-            _log.debug('[{}] new user: {}, {}'.format(self.id, message.author.id, message.author))
+        self.dispatch('message', message)
 
-            # Append user to the user store because we can't fetch the (easily)
-            user = self.store_user(data['author'])
-            self.dispatch('new_user', user)
+    def parse_message_update(self, data):
+        message = self._messages.get(int(data['id'])) if self._messages is not None else None
+        if message is None:
+            _log.debug('[%s] message update for uncached message %s', self.id, data['id'])
+            return None
 
-        self.dispatch('message', message)
+        before = message._copy()
+        message._update(data)
+        self.dispatch('message_edit', before, message)
+
+    def parse_message_delete(self, data):
+        message = self._messages.pop(int(data['id'])) if self._messages is not None else None
+        if message is None:
+            _log.debug('[%s] message delete for uncached message %s', self.id, data['id'])
+            return None
+
+        self.dispatch('message_delete', message)
 
 
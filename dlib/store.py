@@ -0,0 +1,70 @@
+import sys
+
+from collections import OrderedDict, deque
+
+class LRUStore(OrderedDict):
+    # Plain dict interface, reads refresh an entry and writes evict the least recently used one
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+        self.evictions = 0
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if len(self) > self.max_size:
+            self.popitem(last = False)
+            self.evictions += 1
+
+def estimate_size(obj):
+    # Shallow size of a slotted object plus the values it owns, shared references aren't counted
+    size = sys.getsizeof(obj)
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            value = getattr(obj, name, None)
+            if isinstance(value, (str, int, float, bytes, tuple)):
+                size += sys.getsizeof(value)
+            elif isinstance(value, (dict, list)):
+                size += sys.getsizeof(value)
+    return size
+
+def intern_string(value):
+    return sys.intern(value) if value is not None else None
+
+class MessageCache:
+    # Ring buffer of recent messages with an id index, deletes only drop the index entry
+    # and the slot is reclaimed when the ring wraps around
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._ring = deque()
+        self._index = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, message_id):
+        return message_id in self._index
+
+    def __iter__(self):
+        return iter(self._index.values())
+
+    def get(self, message_id):
+        return self._index.get(message_id)
+
+    def append(self, message):
+        if len(self._ring) >= self.max_size:
+            old = self._ring.popleft()
+            if self._index.get(old.id) is old:
+                del self._index[old.id]
+
+        self._ring.append(message)
+        self._index[message.id] = message
+
+    def pop(self, message_id):
+        return self._index.pop(message_id, None)
@@ -1,3 +1,5 @@
+from .store import intern_string
+
 class BaseUser:
     __slots__  = (
         'id',
@@ -16,9 +18,10 @@ class BaseUser:
     def __init__(self, state, data):
         self._state = state
         self.id = int(data['id'])
-        self.username = data['username']
-        self.discriminator = data['discriminator']
-        self.avatar = data['avatar']
+        # Names and avatar hashes repeat a lot across guilds
+        self.username = intern_string(data['username'])
+        self.discriminator = intern_string(data['discriminator'])
+        self.avatar = intern_string(data['avatar'])
         self.bot = data.get('bot', False)
         self.system = data.get('system', False)
         self._banner = data.get('banner')
@@ -26,6 +29,14 @@ class BaseUser:
         self._premium_type = int(data.get('premium_type', 0))
         self.public_flags = int(data.get('public_flags', 0))
     
+    def _update(self, data):
+        # Profile changes ride along on messages, keep the cached user current
+        if (self.username, self.avatar, self.discriminator) != (data['username'], data['avatar'], data['discriminator']):
+            self.username = intern_string(data['username'])
+            self.discriminator = intern_string(data['discriminator'])
+            self.avatar = intern_string(data['avatar'])
+        self.public_flags = int(data.get('public_flags', self.public_flags))
+
     def __repr__(self) -> str:
         return (
             f"<BaseUser id={self.id} name={self.username!r} discriminator={self.discriminator!r}"
@@ -18,4 +18,9 @@ def snowflake_time(id):
     timestamp = ((id >> 22) + DISCORD_EPOCH) / 1000
     return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
 
+def time_snowflake(dt, high = False):
+    # Smallest (or largest) snowflake that can be created at dt
+    discord_millis = int(dt.timestamp() * 1000 - DISCORD_EPOCH)
+    return (discord_millis << 22) + (2**22 - 1 if high else 0)
+
 
@@ -0,0 +1,112 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+
+from .metrics import REGISTRY
+
+_log = logging.getLogger(__name__)
+
+# Seconds, a healthy loop sits in the first few buckets
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class LoopWatchdog:
+    # A task measures how late its sleeps wake up, a thread looks at the loop thread's stack when it stops waking up
+
+    def __init__(self, loop = None, interval = 0.1, threshold = 0.25, registry = REGISTRY):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+
+        self._task = None
+        self._thread = None
+        self._thread_id = None
+        self._stopped = threading.Event()
+        # Written by the loop, read by the watcher thread
+        self._last_tick = time.monotonic()
+        self._stack = None
+
+        # Metric data
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+
+        self._m_lag = registry.histogram('dlib_loop_lag_seconds', 'How late the event loop runs a scheduled wakeup', buckets = LAG_BUCKETS)
+        self._m_stalls = registry.counter('dlib_loop_stalls_total', 'Times the loop was blocked past the threshold')
+        registry.gauge('dlib_loop_lag_max_seconds', 'Worst loop lag since start', func = lambda: self.max_lag)
+
+    def start(self):
+        if self._task is not None:
+            return None
+
+        self.loop = self.loop or asyncio.get_event_loop()
+        self._thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stopped.clear()
+
+        self._task = self.loop.create_task(self._monitor(), name = 'loop_watchdog')
+        self._thread = threading.Thread(target = self._watch, name = 'loop_watchdog', daemon = True)
+        self._thread.start()
+        _log.info('watchdog: watching loop lag every %.0fms, threshold %.0fms', self.interval * 1000, self.threshold * 1000)
+
+    async def close(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._thread is not None:
+            await self.loop.run_in_executor(None, self._thread.join)
+            self._thread = None
+
+    def stats(self):
+        return {
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+            'p99': self._m_lag.quantile(0.99),
+            'stalls': self.stalls
+        }
+
+    async def _monitor(self):
+        loop = self.loop
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            self._last_tick = time.monotonic()
+
+            self.last_lag = lag
+            self._m_lag.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+            if lag > self.threshold:
+                self.stalls += 1
+                self._m_stalls.inc()
+                stack, self._stack = self._stack, None
+                if stack is not None:
+                    _log.warning('watchdog: event loop blocked for %.0fms, it was running:\n%s', lag * 1000, stack)
+                else:
+                    # Too short for the thread to catch it in the act
+                    _log.warning('watchdog: event loop blocked for %.0fms', lag * 1000)
+
+    def _watch(self):
+        # Only reads a timestamp and a frame, never touches the loop itself
+        captured = None
+        while not self._stopped.wait(self.interval):
+            tick = self._last_tick
+            if time.monotonic() - tick < self.threshold + self.interval:
+                continue
+
+            # One capture per stall, the loop resets it by ticking again
+            if captured == tick:
+                continue
+            captured = tick
+
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+
+            self._stack = ''.join(traceback.format_stack(frame))
+            del frame
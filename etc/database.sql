@@ -2,12 +2,19 @@ CREATE TABLE users (
     id BIGINT PRIMARY KEY NOT NULL,
     username VARCHAR(32) NOT NULL,
     discriminator VARCHAR(4) NOT NULL,
-    avatar VARCHAR(32) NOT NULL,
+    -- NULL for the default avatar
+    avatar VARCHAR(32),
     bot BOOLEAN NOT NULL,
     system BOOLEAN NOT NULL,
     public_flags SMALLINT NOT NULL
 );
 
+CREATE TABLE content_dictionaries (
+    id SMALLINT PRIMARY KEY NOT NULL,
+    data BYTEA NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
 CREATE TABLE messages (
     id BIGINT NOT NULL,
     channel_id BIGINT NOT NULL,
@@ -21,8 +28,31 @@ CREATE TABLE messages (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
     content TEXT DEFAULT '' NOT NULL,
+    -- Set when content is stored zstd compressed against content_dictionaries(id), content is '' then
+    content_dict SMALLINT,
+    content_zstd BYTEA,
     PRIMARY KEY(id),
     FOREIGN KEY (author_id) REFERENCES users(id)
+) PARTITION BY RANGE (id);
+
+-- Monthly partitions on the snowflake id (messages_YYYY_MM) are created ahead of time by
+-- DiscordDatabase.ensure_partitions, the default one catches anything outside of them. A month that
+-- already has rows in the default partition gets them moved over when its partition is created
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+-- Keyset pagination by channel (DiscordDatabase.iter_channel_messages)
+CREATE INDEX messages_channel_id_id ON messages (channel_id, id);
+
+-- Edit history, revision 0 is messages.content. Every revision is either a full snapshot in content
+-- or a delta (src/delta.py) against the revision before it, snapshots are forced every SNAPSHOT_INTERVAL
+CREATE TABLE message_revisions (
+    message_id BIGINT NOT NULL,
+    revision INTEGER NOT NULL,
+    edited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    content TEXT,
+    delta BYTEA,
+    PRIMARY KEY (message_id, revision),
+    CHECK ((content IS NULL) <> (delta IS NULL))
 );
 
 -- We create the trigger to update messages.updates_at 
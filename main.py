@@ -1,51 +1,93 @@
 import json
+import signal
 import uvloop
 import asyncio
 import asyncpg
 import logging
 
 from src.database import DiscordDatabase
+from src.writer import BatchWriter
+from src.spool import SpoolWriter
 
 import dlib
 
 with open('etc/config.json') as fp:
     config = json.load(fp)
 
-logger = logging.getLogger('dlib')
-
-logger.setLevel(logging.INFO)
-sh = logging.StreamHandler()
-sh.setFormatter(logging.Formatter('[%(asctime)s][%(levelname)s] %(name)s - %(message)s'))
-logger.addHandler(sh)
+# Records go through a queue to a writer thread, repeated warnings are rate limited
+dlib.setup_logging(level = logging.INFO, names = ('dlib', 'src', 'main'))
+logger = logging.getLogger('main')
 
 class DiscordClient(dlib.Client):
     async def on_ready(self):
-        print('[{}] ready: {}, {}'.format(self.id, self.user.id, self.user))
+        logger.info('[%s] ready: %s, %s', self.id, self.user.id, self.user)
 
     async def on_new_user(self, ctx):
         pass
         #await self._database.insert_user(ctx) 
 
     async def on_message(self, ctx):
-        #await self._database.insert_message(ctx)
-        print('[{}] message: {}, {}, {}:{}, {}, {}'.format(self.id, ctx.created_at, ctx.channel.guild, ctx.channel.name, ctx.author.id, ctx.author, ctx.content))
+        #await self._writer.put_message(ctx)
+        logger.info('[%s] message: %s, %s, %s:%s, %s, %s', self.id, ctx.created_at, ctx.channel.guild, ctx.channel.name, ctx.author.id, ctx.author, ctx.content)
+
+    async def on_message_edit(self, before, after):
+        # Embed resolves also come as edits, only the text goes into the history
+        if before.content != after.content:
+            pass
+            #await self._database.insert_revision(after.id, after.content)
 
 async def main(loop):
     tasks = set()
+    clients = []
+
+    # SIGTERM drains and checkpoints the sessions, the next start resumes them instead of identifying
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+
+    # kill -USR2 toggles hot path profiling, kill -USR1 logs the report
+    dlib.PROFILER.install(loop)
+
+    # Logs the stack of whatever blocks the loop for longer than the threshold
+    watchdog = dlib.LoopWatchdog(loop, **config.get('watchdog', {}))
+    watchdog.start()
+
+    # Prometheus endpoint, enable it with a "metrics": {"host": ..., "port": ...} section
+    if 'metrics' in config:
+        await dlib.MetricsServer(**config['metrics']).start()
     #database = DiscordDatabase(loop = loop, **config['database'])
 
     # Create the database pool for the clients
     #await database.create_pool()
+
+    # Keeps monthly message partitions created ahead, pass retention to detach old months
+    #loop.create_task(database.run_partition_maintenance(ahead = 2))
+
+    # Batches message inserts for all clients, SpoolWriter keeps them on disk while postgres is slow or down
+    #writer = BatchWriter(database, max_rows = 500, max_age = 1.0)
+    #writer = SpoolWriter(database, path = 'var/spool')
+    #writer.start()
     with open('etc/tokens.txt', 'r') as fp:
         for line in fp.readlines():
-            client = DiscordClient(loop=loop, token=line.strip())
+            client = DiscordClient(loop=loop, token=line.strip(), session_dir='var/sessions')
             #client._database = database
+            #client._writer = writer
 
+            clients.append(client)
             tasks.add(loop.create_task(client.connect()))
 
     # Start handling dead clients
-    print('Loaded {} clients'.format(len(tasks)))
-    await asyncio.wait(tasks)
+    logger.info('Loaded %d clients', len(tasks))
+    # Runs until every client died or we are told to stop
+    finished = loop.create_task(asyncio.wait(tasks))
+    stopped = loop.create_task(stop.wait())
+    await asyncio.wait((finished, stopped), return_when=asyncio.FIRST_COMPLETED)
+
+    # Stop reading first, then let the handlers and the writer finish within the deadline
+    logger.info('Shutting down %d clients', len(clients))
+    await asyncio.gather(*(client.close(timeout=10.0) for client in clients))
+    #await asyncio.wait_for(writer.close(), timeout=10.0)
+    await watchdog.close()
 
 loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
@@ -0,0 +1,252 @@
+import os
+import sys
+import zlib
+import mmap
+import struct
+import logging
+import msgspec
+
+from array import array
+
+from dlib.utils import DISCORD_EPOCH
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_log = logging.getLogger(__name__)
+
+MAGIC = b'DLAR'
+TRAILER = struct.Struct('<I4s')
+
+# Column name to array typecode, content is stored as a utf-8 blob plus end offsets
+COLUMNS = {
+    'id': 'q',
+    'channel_id': 'q',
+    'author_id': 'q',
+    'type': 'h',
+    'flags': 'B',
+    'content_offsets': 'q',
+    'content': 'B',
+}
+
+# Bits of the flags column
+MENTION_EVERYONE = 1 << 0
+HAS_ATTACHMENTS = 1 << 1
+HAS_EMBEDS = 1 << 2
+HAS_COMPONENTS = 1 << 3
+
+EXPORT_SQL = """
+    SELECT id, channel_id, author_id, type, mention_everyone, has_attachments, has_embeds, has_components,
+        content, content_dict, content_zstd
+    FROM messages
+    WHERE id > $1 AND id < $2
+    ORDER BY id
+    LIMIT $3
+"""
+
+class ColumnInfo(msgspec.Struct, array_like = True):
+    offset: int
+    length: int
+    size: int
+    compression: str
+
+class SegmentFooter(msgspec.Struct):
+    rows: int
+    min_id: int
+    max_id: int
+    columns: dict[str, ColumnInfo]
+
+class IndexEntry(msgspec.Struct):
+    file: str
+    rows: int
+    min_id: int
+    max_id: int
+
+def timestamps(ids):
+    # Milliseconds since the unix epoch for a whole id column at once, no datetime objects
+    if numpy is not None:
+        return (numpy.frombuffer(ids, dtype = '<i8') >> 22) + DISCORD_EPOCH
+    return array('q', [(snowflake >> 22) + DISCORD_EPOCH for snowflake in ids])
+
+def _little_endian(column):
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
+
+class SegmentWriter:
+
+    def __init__(self, compression = 'zlib', level = 6):
+        self.compression = compression
+        self.level = level
+        self.columns = {name: array(typecode) for name, typecode in COLUMNS.items()}
+        self._content = bytearray()
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def append(self, row):
+        columns = self.columns
+        columns['id'].append(row['id'])
+        columns['channel_id'].append(row['channel_id'])
+        columns['author_id'].append(row['author_id'])
+        columns['type'].append(row['type'])
+        columns['flags'].append(
+            (MENTION_EVERYONE if row['mention_everyone'] else 0)
+            | (HAS_ATTACHMENTS if row['has_attachments'] else 0)
+            | (HAS_EMBEDS if row['has_embeds'] else 0)
+            | (HAS_COMPONENTS if row['has_components'] else 0)
+        )
+        self._content += row['content'].encode()
+        columns['content_offsets'].append(len(self._content))
+
+    def write(self, path):
+        self.columns['content'] = array('B', self._content)
+        ids = self.columns['id']
+        info = {}
+
+        with open(path, 'wb') as fp:
+            fp.write(MAGIC)
+            for name, column in self.columns.items():
+                data = _little_endian(column).tobytes()
+                if self.compression == 'zlib':
+                    data = zlib.compress(data, self.level)
+
+                # Keep uncompressed columns aligned so readers can cast the mapping directly
+                fp.write(bytes(-fp.tell() % 8))
+                info[name] = ColumnInfo(fp.tell(), len(data), len(column), self.compression or 'none')
+                fp.write(data)
+
+            footer = msgspec.msgpack.encode(SegmentFooter(len(ids), ids[0], ids[-1], info))
+            fp.write(footer)
+            fp.write(TRAILER.pack(len(footer), MAGIC))
+
+        return IndexEntry(os.path.basename(path), len(ids), ids[0], ids[-1])
+
+class Segment:
+    # Memory maps a segment, columns are only read and inflated when asked for
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, 'rb')
+        self._mmap = mmap.mmap(self._fp.fileno(), 0, access = mmap.ACCESS_READ)
+
+        length, magic = TRAILER.unpack_from(self._mmap, len(self._mmap) - TRAILER.size)
+        if magic != MAGIC or self._mmap[:4] != MAGIC:
+            raise ValueError('{} is not an archive segment'.format(path))
+
+        start = len(self._mmap) - TRAILER.size - length
+        footer = msgspec.msgpack.decode(self._mmap[start:start + length], type = SegmentFooter)
+        self.rows = footer.rows
+        self.min_id = footer.min_id
+        self.max_id = footer.max_id
+        self._columns = footer.columns
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._mmap.close()
+        self._fp.close()
+
+    def column(self, name):
+        info = self._columns[name]
+        typecode = COLUMNS[name]
+        view = memoryview(self._mmap)[info.offset:info.offset + info.length]
+
+        if info.compression == 'none' and sys.byteorder == 'little':
+            # Zero copy, valid until the segment is closed
+            return view.cast(typecode)
+
+        data = zlib.decompress(view) if info.compression == 'zlib' else bytes(view)
+        view.release()
+        column = array(typecode)
+        column.frombytes(data)
+        if sys.byteorder == 'big':
+            column.byteswap()
+        return column
+
+    def timestamps(self):
+        return timestamps(self.column('id'))
+
+    def content(self):
+        offsets = self.column('content_offsets')
+        blob = bytes(self.column('content'))
+        start = 0
+        result = []
+        for end in offsets:
+            result.append(blob[start:end].decode())
+            start = end
+        return result
+
+class Archive:
+    # A directory of segments plus index.json mapping each file to its snowflake range
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+        self._index_path = os.path.join(path, 'index.json')
+        self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, 'rb') as fp:
+                return msgspec.json.decode(fp.read(), type = list[IndexEntry])
+        except FileNotFoundError:
+            return []
+
+    def _save_index(self):
+        temp = self._index_path + '.tmp'
+        with open(temp, 'wb') as fp:
+            fp.write(msgspec.json.encode(self.index))
+        os.replace(temp, self._index_path)
+
+    def add_segment(self, writer):
+        number = max((int(entry.file[:-4]) for entry in self.index), default = 0) + 1
+        name = '{:08d}.seg'.format(number)
+        entry = writer.write(os.path.join(self.path, name))
+        self.index.append(entry)
+        self.index.sort(key = lambda entry: entry.min_id)
+        self._save_index()
+        _log.info('archive: wrote %s, %d rows, ids %d-%d', name, entry.rows, entry.min_id, entry.max_id)
+        return entry
+
+    def segments(self, after = None, before = None):
+        # Segments overlapping the (after, before) snowflake range
+        for entry in self.index:
+            if after is not None and entry.max_id <= after:
+                continue
+            if before is not None and entry.min_id >= before:
+                continue
+            yield Segment(os.path.join(self.path, entry.file))
+
+async def export_messages(database, path, after = 0, before = 2**63 - 1, segment_rows = 1000000,
+                          page_size = 10000, compression = 'zlib'):
+    # Copies (after, before) out of postgres in id order, one segment per segment_rows
+    archive = Archive(path)
+    writer = SegmentWriter(compression = compression)
+    written = []
+
+    async with database._pool.acquire() as connection:
+        statement = await connection.prepare(EXPORT_SQL)
+        last = after
+        while True:
+            rows = await statement.fetch(last, before, page_size)
+            if not rows:
+                break
+
+            for row in rows:
+                writer.append(await database._decode_row(row, connection))
+                if len(writer) >= segment_rows:
+                    written.append(archive.add_segment(writer))
+                    writer = SegmentWriter(compression = compression)
+            last = rows[-1]['id']
+
+    if len(writer):
+        written.append(archive.add_segment(writer))
+    return written
@@ -0,0 +1,53 @@
+from collections import OrderedDict
+
+class UserCache:
+
+    def __init__(self, max_size = 50000):
+        self.max_size = max_size
+        self._fingerprints = OrderedDict()
+
+        # Metric data
+        self.hits = 0
+        self.misses = 0
+        self.changes = 0
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def changed(self, record, remember = True):
+        # record is the users row, everything past the id is the fingerprint
+        user_id, fingerprint = record[0], record[1:]
+        try:
+            cached = self._fingerprints[user_id]
+        except KeyError:
+            self.misses += 1
+        else:
+            self._fingerprints.move_to_end(user_id)
+            if cached == fingerprint:
+                self.hits += 1
+                return False
+
+            # Known user with a changed profile
+            self.misses += 1
+            self.changes += 1
+
+        if remember:
+            self.remember(record)
+        return True
+
+    def remember(self, record):
+        self._fingerprints[record[0]] = record[1:]
+        self._fingerprints.move_to_end(record[0])
+        if len(self._fingerprints) > self.max_size:
+            self._fingerprints.popitem(last = False)
+
+    def invalidate(self, user_id):
+        self._fingerprints.pop(user_id, None)
+
+    def stats(self):
+        return {
+            'size': len(self._fingerprints),
+            'hits': self.hits,
+            'misses': self.misses,
+            'changes': self.changes
+        }
@@ -0,0 +1,47 @@
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Shorter content doesn't win anything once the frame header is paid for
+MIN_SIZE = 24
+
+def require_zstandard():
+    if zstandard is None:
+        raise RuntimeError('content compression needs the zstandard package')
+
+def train_dictionary(samples, size = 16 * 1024):
+    require_zstandard()
+    samples = [sample.encode() for sample in samples if sample]
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+class ContentCodec:
+    # zstd with a shared dictionary, short chat lines compress well against it
+
+    def __init__(self, dict_id, data, level = 3):
+        require_zstandard()
+        self.dict_id = dict_id
+        self.data = data
+
+        dictionary = zstandard.ZstdCompressionDict(data)
+        # The dictionary id lives in its own column, no need to repeat it (or a checksum) in every frame
+        self._compressor = zstandard.ZstdCompressor(
+            level = level,
+            dict_data = dictionary,
+            write_checksum = False,
+            write_dict_id = False,
+            write_content_size = True
+        )
+        self._decompressor = zstandard.ZstdDecompressor(dict_data = dictionary)
+
+    def compress(self, content):
+        # Returns None when storing the plain text is smaller
+        data = content.encode()
+        if len(data) < MIN_SIZE:
+            return None
+
+        compressed = self._compressor.compress(data)
+        return compressed if len(compressed) < len(data) else None
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data).decode()
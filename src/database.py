@@ -1,5 +1,124 @@
+import re
+import asyncio
+import logging
+import datetime
 import asyncpg
 
+from bisect import bisect_right
+
+from dlib.utils import time_snowflake
+
+from .cache import UserCache
+from .compression import ContentCodec, train_dictionary
+from .delta import apply_delta, encode_revision, rebuild
+
+_log = logging.getLogger(__name__)
+
+MESSAGE_COLUMNS = ('id', 'channel_id', 'author_id', 'type', 'mention_everyone', 'content')
+COMPRESSED_MESSAGE_COLUMNS = MESSAGE_COLUMNS + ('content_dict', 'content_zstd')
+USER_COLUMNS = ('id', 'username', 'discriminator', 'avatar', 'bot', 'system', 'public_flags')
+
+# Only touch the row when the profile actually changed
+UPSERT_USER_SQL = """
+    INSERT INTO users(id, username, discriminator, avatar, bot, system, public_flags)
+    VALUES($1, $2, $3, $4, $5, $6, $7)
+    ON CONFLICT (id) DO UPDATE SET
+        username = EXCLUDED.username,
+        discriminator = EXCLUDED.discriminator,
+        avatar = EXCLUDED.avatar,
+        bot = EXCLUDED.bot,
+        system = EXCLUDED.system,
+        public_flags = EXCLUDED.public_flags
+    WHERE (users.username, users.discriminator, users.avatar, users.public_flags)
+        IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.discriminator, EXCLUDED.avatar, EXCLUDED.public_flags)
+"""
+
+READ_COLUMNS = 'id, channel_id, author_id, type, mention_everyone, created_at, updated_at, content, content_dict, content_zstd'
+
+# Keep the text of these constant, asyncpg prepares each distinct query once per connection and reuses it
+CHANNEL_PAGE_SQL = """
+    SELECT {} FROM messages
+    WHERE channel_id = $1 AND id > $2 AND id < $3
+    ORDER BY id
+    LIMIT $4
+""".format(READ_COLUMNS)
+
+CHANNEL_PAGE_REVERSE_SQL = """
+    SELECT {} FROM messages
+    WHERE channel_id = $1 AND id > $2 AND id < $3
+    ORDER BY id DESC
+    LIMIT $4
+""".format(READ_COLUMNS)
+
+RANGE_SQL = """
+    SELECT {} FROM messages
+    WHERE id > $1 AND id < $2
+    ORDER BY id
+""".format(READ_COLUMNS)
+
+GET_MESSAGE_SQL = """
+    SELECT {} FROM messages WHERE id = $1
+""".format(READ_COLUMNS)
+
+# Everything from the newest snapshot at or below $2 up to $2, that's all a rebuild needs
+REVISION_CHAIN_SQL = """
+    SELECT revision, edited_at, content, delta FROM message_revisions
+    WHERE message_id = $1 AND revision <= $2 AND revision >= coalesce((
+        SELECT max(revision) FROM message_revisions
+        WHERE message_id = $1 AND revision <= $2 AND content IS NOT NULL
+    ), 0)
+    ORDER BY revision
+"""
+
+REVISIONS_SQL = """
+    SELECT revision, edited_at, content, delta FROM message_revisions
+    WHERE message_id = $1
+    ORDER BY revision
+"""
+
+INSERT_REVISION_SQL = """
+    INSERT INTO message_revisions(message_id, revision, edited_at, content, delta)
+    VALUES($1, $2, coalesce($3, now()), $4, $5)
+"""
+
+# The rows themselves are bad, retrying the same batch can never succeed. Anything else
+# (connection loss, timeouts, the server going away) is worth retrying as is
+ROW_ERRORS = (asyncpg.exceptions.DataError, asyncpg.exceptions.IntegrityConstraintViolationError)
+
+MAX_SNOWFLAKE = 2**63 - 1
+MAX_REVISION = 2**31 - 1
+
+PARTITION_BOUND = re.compile(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)")
+
+def user_record(user):
+    return (
+        user.id,
+        user.username,
+        user.discriminator,
+        user.avatar,
+        user.bot,
+        user.system,
+        user.public_flags
+    )
+
+def to_snowflake(value, default):
+    # Range bounds can be given as snowflakes or datetimes
+    if value is None:
+        return default
+    if isinstance(value, datetime.datetime):
+        return time_snowflake(value)
+    return int(value)
+
+def month_start(dt):
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def add_months(dt, months):
+    month = dt.month - 1 + months
+    return dt.replace(year=dt.year + month // 12, month=month % 12 + 1)
+
+def partition_name(start):
+    return 'messages_{:04}_{:02}'.format(start.year, start.month)
+
 class Database:
 
     def __init__(self, **kwargs):
@@ -30,31 +149,439 @@ class Database:
 
 class DiscordDatabase(Database):
 
-    def __init__(self, loop, **kwargs):
+    def __init__(self, loop, user_cache_size = 50000, compress_content = False, **kwargs):
         Database.__init__(self, **kwargs)
         self.loop = loop
 
+        # zstd dictionaries by id, content_codec is the one new rows are written with
+        self.compress_content = compress_content
+        self.content_codec = None
+        self._codecs = {}
+
+        # Users we know are up to date in the database
+        self.users = UserCache(max_size = user_cache_size)
+
+        # Monthly partitions of messages as sorted (lower, upper, name), empty for a flat table
+        self.partitioned = False
+        self._partitions = []
+        self._lowers = []
+        self._default_partition = None
+
+    async def create_pool(self):
+        await Database.create_pool(self)
+        await self.load_partitions()
+        # Don't wait for the maintenance loop, every row until then would land in the default partition
+        await self.ensure_partitions()
+        await self.load_content_dictionaries()
+
+    async def load_content_dictionaries(self, connection = None):
+        # Callers that already hold a connection pass it, a second acquire could wait on a drained pool forever
+        if connection is None:
+            async with self._pool.acquire() as connection:
+                return await self.load_content_dictionaries(connection)
+
+        try:
+            rows = await connection.fetch('SELECT id, data FROM content_dictionaries ORDER BY id')
+        except asyncpg.exceptions.UndefinedTableError:
+            return None
+
+        for row in rows:
+            if row['id'] not in self._codecs:
+                self._codecs[row['id']] = ContentCodec(row['id'], row['data'])
+
+        # Newest dictionary wins for writing
+        if self.compress_content and self._codecs:
+            self.content_codec = self._codecs[max(self._codecs)]
+
+    async def train_content_dictionary(self, sample_size = 20000, dict_size = 16 * 1024, activate = True):
+        # Trains on the most recent messages, that's the traffic new rows will look like.
+        # Compressed rows store '' as content, they're sampled too and decoded with their own dictionary
+        async with self._pool.acquire() as connection:
+            rows = await connection.fetch("""
+                SELECT content, content_dict, content_zstd FROM messages
+                WHERE content <> '' OR content_dict IS NOT NULL
+                ORDER BY id DESC LIMIT $1
+            """, sample_size)
+
+        samples = [(await self._decode_row(row))['content'] for row in rows]
+        data = train_dictionary(samples, size = dict_size)
+        async with self._pool.acquire() as connection:
+            dict_id = await connection.fetchval("""
+                INSERT INTO content_dictionaries(id, data)
+                SELECT coalesce(max(id), 0) + 1, $1 FROM content_dictionaries
+                RETURNING id
+            """, data)
+
+        codec = self._codecs[dict_id] = ContentCodec(dict_id, data)
+        if activate:
+            self.compress_content = True
+            self.content_codec = codec
+
+        _log.info('database: trained content dictionary %d, %d bytes from %d messages', dict_id, len(data), len(rows))
+        return dict_id
+
+    def _encode_messages(self, messages):
+        # Swaps content for (dictionary id, zstd blob) where that's smaller
+        codec = self.content_codec
+        if codec is None:
+            return MESSAGE_COLUMNS, messages
+
+        encoded = []
+        for row in messages:
+            blob = codec.compress(row[5])
+            if blob is None:
+                encoded.append((*row, None, None))
+            else:
+                encoded.append((*row[:5], '', codec.dict_id, blob))
+        return COMPRESSED_MESSAGE_COLUMNS, encoded
+
+    async def _decode_row(self, row, connection = None):
+        # Always a dict with the storage columns dropped, callers can't tell how the content was stored
+        row = dict(row)
+        dict_id = row.pop('content_dict')
+        blob = row.pop('content_zstd')
+        if dict_id is None:
+            return row
+
+        if dict_id not in self._codecs:
+            await self.load_content_dictionaries(connection)
+
+        row['content'] = self._codecs[dict_id].decompress(blob)
+        return row
+
+    async def load_partitions(self):
+        async with self._pool.acquire() as connection:
+            kind = await connection.fetchval("SELECT relkind::text FROM pg_class WHERE oid = 'messages'::regclass")
+            self.partitioned = kind == 'p'
+            if not self.partitioned:
+                return None
+
+            rows = await connection.fetch("""
+                SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'messages'::regclass
+            """)
+
+        partitions = []
+        self._default_partition = None
+        for row in rows:
+            # The default partition has no range, rows outside ours go through the parent
+            match = PARTITION_BOUND.search(row['bound'])
+            if match:
+                partitions.append((int(match.group(1)), int(match.group(2)), row['relname']))
+            elif row['bound'] == 'DEFAULT':
+                self._default_partition = row['relname']
+
+        self._partitions = sorted(partitions)
+        self._lowers = [lower for lower, _, _ in self._partitions]
+
+    async def ensure_partitions(self, ahead = 2, now = None):
+        # Create this month and the next few so inserts never wait on DDL
+        if not self.partitioned:
+            return []
+
+        start = month_start(now or datetime.datetime.now(datetime.timezone.utc))
+        created = []
+        stale = False
+        async with self._pool.acquire() as connection:
+            for month in range(ahead + 1):
+                lower = add_months(start, month)
+                name = partition_name(lower)
+                if any(known == name for _, _, known in self._partitions):
+                    continue
+
+                if self._default_partition is None:
+                    await connection.execute(
+                        'CREATE TABLE IF NOT EXISTS {} PARTITION OF messages FOR VALUES FROM ({}) TO ({})'.format(
+                            name, time_snowflake(lower), time_snowflake(add_months(lower, 1)))
+                    )
+                else:
+                    moved = await self._create_from_default(connection, name, lower)
+                    if moved is None:
+                        stale = True
+                        continue
+                    if moved:
+                        _log.warning('database: moved %d rows from %s into %s', moved, self._default_partition, name)
+                created.append(name)
+
+        if created:
+            _log.info('database: created partitions %s', ', '.join(created))
+        if created or stale:
+            await self.load_partitions()
+        return created
+
+    async def _create_from_default(self, connection, name, lower):
+        # CREATE ... PARTITION OF fails once the default partition holds rows of that month, so the month
+        # is built as a plain table, its rows are moved over and it's attached in one transaction.
+        # Returns the rows moved, None when the month was left alone
+        bounds = (time_snowflake(lower), time_snowflake(add_months(lower, 1)))
+        async with connection.transaction():
+            # The attach needs this lock anyway, taking it first means nothing lands in the default partition after the move
+            await connection.execute('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE'.format(self._default_partition))
+
+            # Another process may have created the month while we waited for the lock
+            attached = await connection.fetchval("""
+                SELECT EXISTS(SELECT 1 FROM pg_inherits WHERE inhrelid = r AND inhparent = 'messages'::regclass)
+                FROM to_regclass($1) r WHERE r IS NOT NULL
+            """, name)
+            if attached is not None:
+                if not attached:
+                    _log.warning('database: %s exists but is not a partition of messages, not creating that month', name)
+                return None
+
+            await connection.execute('CREATE TABLE {} (LIKE messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'.format(name))
+            status = await connection.execute("""
+                WITH moved AS (DELETE FROM {} WHERE id >= $1 AND id < $2 RETURNING *)
+                INSERT INTO {} SELECT * FROM moved
+            """.format(self._default_partition, name), *bounds)
+            await connection.execute('ALTER TABLE messages ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})'.format(name, *bounds))
+        return int(status.split()[-1])
+
+    async def detach_partitions(self, retention, drop = False, now = None):
+        # Whole months older than retention (a timedelta) are detached, that's a catalog change not a DELETE
+        if not self.partitioned:
+            return []
+
+        cutoff = time_snowflake((now or datetime.datetime.now(datetime.timezone.utc)) - retention)
+        expired = [name for _, upper, name in self._partitions if upper <= cutoff]
+
+        async with self._pool.acquire() as connection:
+            for name in expired:
+                await connection.execute('ALTER TABLE messages DETACH PARTITION {}'.format(name))
+                if drop:
+                    await connection.execute('DROP TABLE {}'.format(name))
+
+        if expired:
+            _log.info('database: %s partitions %s', 'dropped' if drop else 'detached', ', '.join(expired))
+            await self.load_partitions()
+        return expired
+
+    async def run_partition_maintenance(self, interval = 3600, ahead = 2, retention = None, drop = False):
+        while True:
+            try:
+                await self.ensure_partitions(ahead = ahead)
+                if retention is not None:
+                    await self.detach_partitions(retention, drop = drop)
+            except Exception:
+                _log.exception('database: partition maintenance failed')
+            await asyncio.sleep(interval)
+
+    def _route(self, messages):
+        # Partitions touched by the batch, None when a row falls outside the ones we manage
+        touched = {}
+        for row in messages:
+            index = bisect_right(self._lowers, row[0]) - 1
+            if index < 0 or row[0] >= self._partitions[index][1]:
+                return None
+            touched[index] = self._partitions[index]
+        return touched.values()
+
     async def insert_user(self, ctx):
-        sql = """
-            INSERT INTO users(id, username, discriminator, avatar, bot, system, public_flags)
-            VALUES($1, $2, $3, $4, $5, $6, $7)
-        """
-        await self.insert(sql, (
-            ctx.id, 
-            ctx.username, 
-            ctx.discriminator,
-            ctx.avatar,
-            ctx.bot,
-            ctx.system,
-            ctx.public_flags
-        ))
+        record = user_record(ctx)
+        # Remembered only once the row is committed, another client logging the same message
+        # would otherwise skip the user and insert a message referencing a row that isn't there yet
+        if not self.users.changed(record, remember = False):
+            return None
+
+        # Concurrent upserts of one user are fine, the later one waits for the first to commit
+        await self.insert(UPSERT_USER_SQL, record)
+        self.users.remember(record)
 
     async def insert_message(self, ctx):
+        columns, (record,) = self._encode_messages([ctx.record])
         sql = """
-            INSERT INTO messages(id, channel_id, author_id, type, mention_everyone, content)
-            VALUES($1, $2, $3, $4, $5, $6)
-        """
+            INSERT INTO messages({})
+            VALUES({})
+        """.format(', '.join(columns), ', '.join('${}'.format(i + 1) for i in range(len(columns))))
+
         # Insert both the user and message
         await self.insert_user(ctx.author)
-        await self.insert(sql, (ctx.id, ctx.channel.id, ctx.author.id, ctx.type, ctx.everyone, ctx.content))
-        
+        await self.insert(sql, record)
+
+    async def insert_batch(self, users, messages):
+        # Bulk path used by the writer, one transaction per batch
+        copy_columns, records = self._encode_messages(messages)
+        columns = ', '.join(copy_columns)
+        async with self._pool.acquire() as connection:
+            async with connection.transaction():
+                # Users first, messages reference them
+                if users:
+                    await connection.executemany(UPSERT_USER_SQL, users)
+
+                if messages:
+                    # COPY can't skip duplicates (multiple clients see the same message),
+                    # so we copy into a staging table and merge from there
+                    await connection.execute("""
+                        CREATE TEMP TABLE IF NOT EXISTS messages_staging
+                        (LIKE messages INCLUDING DEFAULTS) ON COMMIT DELETE ROWS
+                    """)
+                    await connection.copy_records_to_table(
+                        'messages_staging',
+                        records = records,
+                        columns = copy_columns
+                    )
+
+                    partitions = self._route(messages) if self._partitions else None
+                    if partitions is None:
+                        await connection.execute("""
+                            INSERT INTO messages({0}) SELECT {0} FROM messages_staging
+                            ON CONFLICT (id) DO NOTHING
+                        """.format(columns))
+                    else:
+                        # Straight into the partition, skips tuple routing through the parent
+                        for lower, upper, name in partitions:
+                            await connection.execute("""
+                                INSERT INTO {1}({0}) SELECT {0} FROM messages_staging
+                                WHERE id >= $1 AND id < $2
+                                ON CONFLICT (id) DO NOTHING
+                            """.format(columns, name), lower, upper)
+
+    async def insert_rows(self, users, messages):
+        # Slow path for a batch rejected over its data, every row on its own so one bad row only costs itself.
+        # Returns the rows the database refused as ([(user, error)], [(message, error)]), anything else is raised
+        copy_columns, records = self._encode_messages(messages)
+        sql = """
+            INSERT INTO messages({})
+            VALUES({})
+            ON CONFLICT (id) DO NOTHING
+        """.format(', '.join(copy_columns), ', '.join('${}'.format(i + 1) for i in range(len(copy_columns))))
+
+        bad_users = []
+        bad_messages = []
+        async with self._pool.acquire() as connection:
+            for user in users:
+                try:
+                    await connection.execute(UPSERT_USER_SQL, *user)
+                except ROW_ERRORS as e:
+                    # Let a later, fixed profile through
+                    self.users.invalidate(user[0])
+                    bad_users.append((user, e))
+
+            for message, record in zip(messages, records):
+                try:
+                    await connection.execute(sql, *record)
+                except ROW_ERRORS as e:
+                    bad_messages.append((message, e))
+
+        return bad_users, bad_messages
+
+    async def _original_content(self, connection, message_id):
+        # Revision 0 is the message as it was created, None once its partition is gone
+        row = await connection.fetchrow(GET_MESSAGE_SQL, message_id)
+        return (await self._decode_row(row, connection))['content'] if row is not None else None
+
+    async def _rebuild_revision(self, connection, message_id, rows):
+        # Rows come from REVISION_CHAIN_SQL, the original is only needed when the chain doesn't start with a snapshot
+        base = None
+        if not rows or rows[0]['content'] is None:
+            base = await self._original_content(connection, message_id)
+            if base is None and rows:
+                return None
+        return rebuild(base, ((row['content'], row['delta']) for row in rows))
+
+    async def insert_revision(self, message_id, content, edited_at = None):
+        # Returns the new revision number, None when nothing changed (every client sees the same edit)
+        async with self._pool.acquire() as connection:
+            async with connection.transaction():
+                # Concurrent edits of one message would otherwise pick the same number or a stale base
+                await connection.execute('SELECT pg_advisory_xact_lock($1)', message_id)
+
+                rows = await connection.fetch(REVISION_CHAIN_SQL, message_id, MAX_REVISION)
+                previous = await self._rebuild_revision(connection, message_id, rows)
+                if previous == content:
+                    return None
+
+                revision = rows[-1]['revision'] + 1 if rows else 1
+                if previous is None:
+                    # Nothing to diff against, the create was never logged
+                    snapshot, delta = content, None
+                else:
+                    snapshot, delta = encode_revision(revision, previous, content)
+
+                await connection.execute(INSERT_REVISION_SQL, message_id, revision, edited_at, snapshot, delta)
+        return revision
+
+    async def get_revision(self, message_id, revision = None):
+        # Any revision (the latest for None) as {'revision', 'edited_at', 'content'}, 0 is the original message
+        async with self._pool.acquire() as connection:
+            if revision != 0:
+                rows = await connection.fetch(REVISION_CHAIN_SQL, message_id, MAX_REVISION if revision is None else revision)
+                if rows:
+                    if revision is not None and rows[-1]['revision'] != revision:
+                        return None
+                    content = await self._rebuild_revision(connection, message_id, rows)
+                    return {'revision': rows[-1]['revision'], 'edited_at': rows[-1]['edited_at'], 'content': content}
+                if revision is not None:
+                    return None
+
+            # Revision 0, or the latest of a message that was never edited, on the same connection
+            row = await connection.fetchrow(GET_MESSAGE_SQL, message_id)
+            if row is None:
+                return None
+            row = await self._decode_row(row, connection)
+
+        return {'revision': 0, 'edited_at': row['created_at'], 'content': row['content']}
+
+    async def get_revisions(self, message_id):
+        # The whole history in one pass, each delta applies to the content before it
+        async with self._pool.acquire() as connection:
+            rows = await connection.fetch(REVISIONS_SQL, message_id)
+            original = await connection.fetchrow(GET_MESSAGE_SQL, message_id)
+
+        history = []
+        content = None
+        if original is not None:
+            original = await self._decode_row(original)
+            content = original['content']
+            history.append({'revision': 0, 'edited_at': original['created_at'], 'content': content})
+
+        for row in rows:
+            if row['content'] is not None:
+                content = row['content']
+            elif content is not None:
+                content = apply_delta(content, row['delta'])
+            history.append({'revision': row['revision'], 'edited_at': row['edited_at'], 'content': content})
+        return history
+
+    async def get_message(self, message_id):
+        async with self._pool.acquire() as connection:
+            row = await connection.fetchrow(GET_MESSAGE_SQL, message_id)
+        return await self._decode_row(row) if row is not None else None
+
+    async def iter_channel_messages(self, channel_id, after = None, before = None, limit = None,
+                                    oldest_first = True, page_size = 1000):
+        # Keyset pagination on the id, every page is an index range scan no matter how deep we are.
+        # The connection goes back to the pool between pages so slow consumers don't pin it
+        lower = to_snowflake(after, 0)
+        upper = to_snowflake(before, MAX_SNOWFLAKE)
+        sql = CHANNEL_PAGE_SQL if oldest_first else CHANNEL_PAGE_REVERSE_SQL
+        remaining = limit
+
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(page_size, remaining)
+            async with self._pool.acquire() as connection:
+                rows = await connection.fetch(sql, channel_id, lower, upper, size)
+
+            for row in rows:
+                yield await self._decode_row(row)
+
+            if len(rows) < size:
+                return
+
+            if oldest_first:
+                lower = rows[-1]['id']
+            else:
+                upper = rows[-1]['id']
+
+            if remaining is not None:
+                remaining -= len(rows)
+
+    async def stream_messages(self, after = None, before = None, prefetch = 1000):
+        # Server side cursor over a whole id range, one connection and transaction for the scan
+        lower = to_snowflake(after, 0)
+        upper = to_snowflake(before, MAX_SNOWFLAKE)
+
+        async with self._pool.acquire() as connection:
+            async with connection.transaction():
+                async for row in connection.cursor(RANGE_SQL, lower, upper, prefetch = prefetch):
+                    yield await self._decode_row(row, connection)
@@ -0,0 +1,66 @@
+import difflib
+import msgspec
+
+# Every revision with revision % SNAPSHOT_INTERVAL == 0 is stored in full, rebuilding one never applies more deltas than this
+SNAPSHOT_INTERVAL = 16
+
+_encoder = msgspec.msgpack.Encoder()
+_decoder = msgspec.msgpack.Decoder()
+
+def make_delta(old, new):
+    # A flat msgpack list, two ints copy old[start:end] and a string is inserted as is
+    end = min(len(old), len(new))
+    prefix = 0
+    while prefix < end and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < end - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+
+    ops = []
+    if prefix:
+        ops += (0, prefix)
+
+    # Most edits touch one spot, only diff what's left between the shared prefix and suffix
+    middle = difflib.SequenceMatcher(None, old[prefix:len(old) - suffix], new[prefix:len(new) - suffix], autojunk = False)
+    for tag, i1, i2, j1, j2 in middle.get_opcodes():
+        if tag == 'equal':
+            ops += (prefix + i1, prefix + i2)
+        elif j2 > j1:
+            ops.append(new[prefix + j1:prefix + j2])
+
+    if suffix:
+        ops += (len(old) - suffix, len(old))
+    return _encoder.encode(ops)
+
+def apply_delta(old, delta):
+    ops = _decoder.decode(delta)
+    parts = []
+    i = 0
+    while i < len(ops):
+        op = ops[i]
+        if type(op) is str:
+            parts.append(op)
+            i += 1
+        else:
+            parts.append(old[op:ops[i + 1]])
+            i += 2
+    return ''.join(parts)
+
+def encode_revision(revision, old, new):
+    # (content, delta), exactly one of them is set
+    if revision % SNAPSHOT_INTERVAL == 0:
+        return new, None
+
+    delta = make_delta(old, new)
+    # Rewrites share nothing with the old text, the delta would only be overhead
+    if len(delta) >= len(new.encode()):
+        return new, None
+    return None, delta
+
+def rebuild(base, chain):
+    # Replays (content, delta) pairs on top of base, a full content resets the chain
+    content = base
+    for snapshot, delta in chain:
+        content = snapshot if snapshot is not None else apply_delta(content, delta)
+    return content
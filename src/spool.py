@@ -0,0 +1,304 @@
+import os
+import time
+import struct
+import asyncio
+import logging
+import msgspec
+
+from typing import Tuple
+
+from dlib.backoff import ExponentialBackoff
+from dlib.metrics import REGISTRY
+
+from .database import ROW_ERRORS, user_record
+
+_log = logging.getLogger(__name__)
+
+# Every record is a little endian u32 length followed by a msgpack (kind, row) pair
+HEADER = struct.Struct('<I')
+
+USER = 0
+MESSAGE = 1
+
+class Spool:
+    # Append only segment files, the replayer reads them back in order and deletes what it finished
+
+    def __init__(self, path, segment_size = 64 * 1024 * 1024, fsync = False):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        os.makedirs(path, exist_ok = True)
+
+        self._encoder = msgspec.msgpack.Encoder()
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 1
+        self._repair(self.segment)
+        self._fp = open(self._segment_path(self.segment), 'ab', buffering = 1024 * 1024)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '{:08d}.spool'.format(segment))
+
+    def segments(self):
+        return sorted(int(name[:-6]) for name in os.listdir(self.path) if name.endswith('.spool'))
+
+    def _repair(self, segment):
+        # A crash can leave half a record at the end, cut it off before appending behind it
+        path = self._segment_path(segment)
+        if not os.path.exists(path):
+            return None
+
+        end = 0
+        with open(path, 'rb') as fp:
+            while True:
+                header = fp.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                size, = HEADER.unpack(header)
+                if len(fp.read(size)) < size:
+                    break
+                end = fp.tell()
+
+        if end < os.path.getsize(path):
+            _log.warning('spool: truncating torn record at %s:%d', path, end)
+            os.truncate(path, end)
+
+    def append(self, kind, record):
+        data = self._encoder.encode((kind, record))
+        self._fp.write(HEADER.pack(len(data)))
+        self._fp.write(data)
+
+        if self._fp.tell() >= self.segment_size:
+            self._rotate()
+
+    def _rotate(self):
+        fp = self._fp
+        fp.flush()
+        self.segment += 1
+        self._fp = open(self._segment_path(self.segment), 'ab', buffering = 1024 * 1024)
+
+        if self.fsync:
+            # append() runs on the loop, the finished segment is synced and closed in a thread
+            asyncio.get_running_loop().run_in_executor(None, self._sync_and_close, fp)
+        else:
+            fp.close()
+
+    def _sync_and_close(self, fp):
+        with fp:
+            os.fsync(fp.fileno())
+
+    def flush(self):
+        self._fp.flush()
+        if self.fsync:
+            os.fsync(self._fp.fileno())
+
+    async def sync(self):
+        # Same as flush() without blocking the loop on the disk, a rotate can't close the fd we sync under us
+        self._fp.flush()
+        if self.fsync:
+            fd = os.dup(self._fp.fileno())
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, os.fsync, fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        self.flush()
+        self._fp.close()
+
+class SpoolWriter:
+    # Same interface as BatchWriter, writes land on disk first and reach postgres from a replayer
+
+    def __init__(self, database, path, segment_size = 64 * 1024 * 1024, fsync = False, batch_size = 1000, interval = 0.5):
+        self.database = database
+        self.spool = Spool(path, segment_size = segment_size, fsync = fsync)
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self._checkpoint_path = os.path.join(path, 'checkpoint')
+        # Records the database refused, same format as a segment so they can be fixed up and replayed by hand
+        self._quarantine_path = os.path.join(path, 'quarantine')
+        self._decoder = msgspec.msgpack.Decoder(Tuple[int, tuple])
+        self.segment, self.offset = self._load_checkpoint()
+        self._task = None
+
+        # Metric data
+        self.appended = 0
+        self.replayed = 0
+        self.failed_flushes = 0
+        self.quarantined = 0
+        self.last_flush_latency = 0.0
+
+        REGISTRY.gauge('dlib_spool_lag_records', 'Records spooled but not in the database', func=lambda: self.pending)
+        self._m_flush = REGISTRY.histogram('dlib_db_flush_seconds', 'Batch insert latency')
+        self._m_rows = REGISTRY.counter('dlib_db_rows_written_total', 'Rows written by the batch writer')
+        self._m_quarantined = REGISTRY.counter('dlib_spool_quarantined_records_total', 'Records the database refused')
+
+    @property
+    def pending(self):
+        # Only exact for this process, records left over from a previous run aren't counted
+        return max(self.appended - self.replayed, 0)
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'segment': self.spool.segment,
+            'checkpoint': (self.segment, self.offset),
+            'appended': self.appended,
+            'replayed': self.replayed,
+            'failed_flushes': self.failed_flushes,
+            'quarantined': self.quarantined,
+            'last_flush_latency': self.last_flush_latency
+        }
+
+    def _load_checkpoint(self):
+        try:
+            with open(self._checkpoint_path, 'rb') as fp:
+                segment, offset = msgspec.json.decode(fp.read())
+        except FileNotFoundError:
+            segments = self.spool.segments()
+            return (segments[0] if segments else self.spool.segment), 0
+
+        _log.info('spool: resuming replay from segment %d offset %d', segment, offset)
+        return segment, offset
+
+    def _save_checkpoint(self):
+        # Write and rename so a crash never leaves half a checkpoint
+        temp = self._checkpoint_path + '.tmp'
+        with open(temp, 'wb') as fp:
+            fp.write(msgspec.json.encode((self.segment, self.offset)))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp, self._checkpoint_path)
+
+    def _quarantine(self, records):
+        with open(self._quarantine_path, 'ab') as fp:
+            for record in records:
+                data = self.spool._encoder.encode(record)
+                fp.write(HEADER.pack(len(data)))
+                fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    async def put_message(self, ctx):
+        user = user_record(ctx.author)
+        if self.database.users.changed(user):
+            self.spool.append(USER, user)
+            self.appended += 1
+
+        self.spool.append(MESSAGE, ctx.record)
+        self.appended += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(), name = 'spool_replayer')
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        # Drain what we can, whatever is left gets replayed on the next start
+        try:
+            while await self.replay():
+                pass
+        finally:
+            self.spool.close()
+
+    async def run(self):
+        backoff = ExponentialBackoff()
+        while True:
+            try:
+                replayed = await self.replay()
+            except Exception:
+                # The records stay on disk, back off so an outage doesn't turn into a busy loop
+                self.failed_flushes += 1
+                retry = backoff.delay()
+                _log.exception('spool: replay failed at segment %d offset %d, retrying in %.2fs',
+                    self.segment, self.offset, retry)
+                await asyncio.sleep(retry)
+                continue
+
+            if replayed < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+    def _read_batch(self):
+        records = []
+        path = self.spool._segment_path(self.segment)
+        try:
+            fp = open(path, 'rb')
+        except FileNotFoundError:
+            return records, self.offset
+
+        with fp:
+            fp.seek(self.offset)
+            offset = self.offset
+            while len(records) < self.batch_size:
+                header = fp.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                size, = HEADER.unpack(header)
+                data = fp.read(size)
+                if len(data) < size:
+                    break
+                records.append(self._decoder.decode(data))
+                offset = fp.tell()
+
+        return records, offset
+
+    def _next_segment(self):
+        # Only move past segments the writer is done with, runs in the executor like _read_batch
+        if self.segment >= self.spool.segment:
+            return False
+
+        finished = self.spool._segment_path(self.segment)
+        # The writer can append and rotate between our read hitting the end and here, _rotate flushes
+        # before bumping spool.segment so the size is final, only leave once all of it is replayed
+        if os.path.getsize(finished) > self.offset:
+            return False
+
+        self.segment = min(segment for segment in self.spool.segments() if segment > self.segment)
+        self.offset = 0
+        self._save_checkpoint()
+        os.remove(finished)
+        return True
+
+    async def replay(self):
+        await self.spool.sync()
+
+        loop = asyncio.get_running_loop()
+        records, offset = await loop.run_in_executor(None, self._read_batch)
+        if not records:
+            await loop.run_in_executor(None, self._next_segment)
+            return 0
+
+        users = [record for kind, record in records if kind == USER]
+        messages = [record for kind, record in records if kind == MESSAGE]
+
+        start = time.perf_counter()
+        try:
+            await self.database.insert_batch(users, messages)
+        except ROW_ERRORS as e:
+            # Retrying from the same offset would fail forever while the spool grows, set the bad rows aside
+            _log.warning('spool: batch at segment %d offset %d rejected (%s), retrying row by row', self.segment, self.offset, e)
+            bad_users, bad_messages = await self.database.insert_rows(users, messages)
+            rejected = [(USER, row) for row, _ in bad_users] + [(MESSAGE, row) for row, _ in bad_messages]
+            for (kind, row), (_, error) in zip(rejected, bad_users + bad_messages):
+                _log.error('spool: quarantining %s row %s: %s', 'user' if kind == USER else 'message', row, error)
+
+            await loop.run_in_executor(None, self._quarantine, rejected)
+            self.quarantined += len(rejected)
+            self._m_quarantined.inc(len(rejected))
+        latency = time.perf_counter() - start
+
+        # The rows are committed, a crash before the checkpoint only replays idempotent inserts
+        self.offset = offset
+        await loop.run_in_executor(None, self._save_checkpoint)
+
+        self.replayed += len(records)
+        self.last_flush_latency = latency
+        self._m_flush.observe(latency)
+        self._m_rows.inc(len(records))
+
+        _log.debug('spool: replayed %d records in %.1fms, segment %d offset %d',
+            len(records), latency * 1000, self.segment, self.offset)
+        return len(records)
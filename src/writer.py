@@ -0,0 +1,147 @@
+import time
+import asyncio
+import logging
+
+from dlib.metrics import REGISTRY
+
+from .database import ROW_ERRORS, user_record
+
+_log = logging.getLogger(__name__)
+
+class BatchWriter:
+
+    def __init__(self, database, max_rows = 500, max_age = 1.0, max_pending = 20000):
+        self.database = database
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.max_pending = max_pending
+
+        # Pending rows, users are keyed by id so a batch only carries one row per user
+        self._users = {}
+        self._messages = []
+        self._oldest = None
+        self._in_flight = 0
+
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._flush_task = None
+
+        # Metric data
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.rejected_rows = 0
+        self.rows_written = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+        REGISTRY.gauge('dlib_db_pending_rows', 'Rows waiting to be written', func=lambda: self.pending)
+        self._m_flush = REGISTRY.histogram('dlib_db_flush_seconds', 'Batch insert latency')
+        self._m_rows = REGISTRY.counter('dlib_db_rows_written_total', 'Rows written by the batch writer')
+        self._m_rejected = REGISTRY.counter('dlib_db_rejected_rows_total', 'Rows the database refused, dropped after logging')
+
+    @property
+    def pending(self):
+        # Rows queued plus the rows of the batch currently being written
+        return len(self._users) + len(self._messages) + self._in_flight
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'rejected_rows': self.rejected_rows,
+            'rows_written': self.rows_written,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency
+        }
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(), name = 'batch_writer')
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def run(self):
+        # Age based flushing, row count flushing happens in put_message
+        while True:
+            await asyncio.sleep(self.max_age / 2)
+            if self._oldest is not None and time.monotonic() - self._oldest >= self.max_age:
+                await self.flush()
+
+    async def put_message(self, ctx):
+        user = user_record(ctx.author)
+        if self.database.users.changed(user):
+            self._users[user[0]] = user
+        self._messages.append(ctx.record)
+
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+        if len(self._messages) >= self.max_rows:
+            if self.pending >= self.max_pending:
+                # The database is behind, hold the caller until the current batch is out
+                await self.flush()
+            elif self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self.flush(), name = 'batch_writer_flush')
+
+    def _reject(self, users, messages):
+        for kind, rows in (('user', users), ('message', messages)):
+            for row, error in rows:
+                _log.error('writer: dropping %s row %s: %s', kind, row, error)
+        rejected = len(users) + len(messages)
+        self.rejected_rows += rejected
+        self._m_rejected.inc(rejected)
+        return rejected
+
+    async def flush(self):
+        async with self._lock:
+            if not self._messages and not self._users:
+                return None
+
+            users, self._users = list(self._users.values()), {}
+            messages, self._messages = self._messages, []
+            self._oldest = None
+            self._in_flight = len(users) + len(messages)
+
+            start = time.perf_counter()
+            rejected = 0
+            try:
+                try:
+                    await self.database.insert_batch(users, messages)
+                except ROW_ERRORS as e:
+                    # Requeueing would fail the same way forever, write row by row and drop what's refused
+                    _log.warning('writer: batch of %d rows rejected (%s), retrying row by row', self._in_flight, e)
+                    rejected = self._reject(*await self.database.insert_rows(users, messages))
+            except Exception:
+                self.failed_flushes += 1
+                _log.exception('writer: flush of %d rows failed, requeueing', self._in_flight)
+
+                # Put the rows back in front, newer user rows win
+                self._messages[:0] = messages
+                self._users = {**{user[0]: user for user in users}, **self._users}
+                self._oldest = self._oldest or time.monotonic()
+
+                # Stay bounded while the database is down
+                overflow = len(self._messages) - self.max_pending
+                if overflow > 0:
+                    del self._messages[:overflow]
+                    _log.warning('writer: dropped %d messages over max_pending', overflow)
+                return None
+            finally:
+                self._in_flight = 0
+
+            latency = time.perf_counter() - start
+            written = len(users) + len(messages) - rejected
+            self.flushes += 1
+            self.rows_written += written
+            self.last_flush_latency = latency
+            self._m_flush.observe(latency)
+            self._m_rows.inc(written)
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+
+            _log.debug('writer: flushed %d users, %d messages in %.1fms, %d pending',
+                len(users), len(messages), latency * 1000, self.pending)
@@ -0,0 +1,107 @@
+import random
+import asyncio
+import asyncpg
+
+from src.spool import HEADER, SpoolWriter
+
+class Users:
+
+    def changed(self, record):
+        return False
+
+class Database:
+
+    def __init__(self):
+        self.users = Users()
+        self.messages = []
+
+    async def insert_batch(self, users, messages):
+        if any(row[5] == 'bad' for row in messages):
+            raise asyncpg.exceptions.CheckViolationError('bad content')
+        self.messages.extend(row[0] for row in messages)
+
+    async def insert_rows(self, users, messages):
+        bad = []
+        for row in messages:
+            if row[5] == 'bad':
+                bad.append((row, asyncpg.exceptions.CheckViolationError('bad content')))
+            else:
+                self.messages.append(row[0])
+        return [], bad
+
+class Author:
+    id = 1
+    username = 'user'
+    discriminator = '0'
+    avatar = None
+    bot = False
+    system = False
+    public_flags = 0
+
+class Message:
+    author = Author()
+
+    def __init__(self, id, content = 'x' * 40):
+        self.record = (id, 2, 1, 0, False, content)
+
+async def drain(writer):
+    # replay() returns 0 when it moves to the next segment too, stop once nothing is pending
+    for _ in range(10000):
+        await writer.replay()
+        if not writer.pending:
+            return None
+
+def test_rotate_after_reading_to_the_end(tmp_path):
+    async def run():
+        database = Database()
+        writer = SpoolWriter(database, path = str(tmp_path), segment_size = 4000, batch_size = 1000)
+        for i in range(10):
+            await writer.put_message(Message(i))
+        await writer.replay()
+        assert await writer.replay() == 0
+
+        # The writer appends to the segment we just finished reading and rotates before we move on
+        for i in range(10, 100):
+            await writer.put_message(Message(i))
+        assert writer.spool.segment > writer.segment
+        await asyncio.get_running_loop().run_in_executor(None, writer._next_segment)
+
+        await drain(writer)
+        writer.spool.close()
+        assert database.messages == list(range(100))
+
+    asyncio.run(run())
+
+def test_interleaved_appends_and_replays(tmp_path):
+    async def run():
+        rand = random.Random(0)
+        database = Database()
+        writer = SpoolWriter(database, path = str(tmp_path), segment_size = 4000, batch_size = 50)
+        for i in range(6000):
+            await writer.put_message(Message(i))
+            if rand.random() < 0.05:
+                await writer.replay()
+
+        await drain(writer)
+        writer.spool.close()
+        assert database.messages == list(range(6000))
+
+    asyncio.run(run())
+
+def test_bad_row_is_quarantined(tmp_path):
+    async def run():
+        database = Database()
+        writer = SpoolWriter(database, path = str(tmp_path), batch_size = 1000)
+        for i in range(10):
+            await writer.put_message(Message(i, 'bad' if i == 4 else 'x'))
+
+        await drain(writer)
+        writer.spool.close()
+        assert database.messages == [0, 1, 2, 3, 5, 6, 7, 8, 9]
+        assert writer.quarantined == 1
+
+        data = (tmp_path / 'quarantine').read_bytes()
+        size, = HEADER.unpack(data[:HEADER.size])
+        assert writer._decoder.decode(data[HEADER.size:HEADER.size + size])[1][0] == 4
+
+    asyncio.run(run())
@@ -0,0 +1,76 @@
+import asyncio
+import asyncpg
+
+from src.cache import UserCache
+from src.writer import BatchWriter
+
+class Database:
+    # Refuses any message with content 'bad' the way a constraint would
+
+    def __init__(self, down = 0):
+        self.users = UserCache()
+        self.messages = []
+        self.down = down
+
+    async def insert_batch(self, users, messages):
+        if self.down:
+            self.down -= 1
+            raise ConnectionResetError()
+        if any(row[5] == 'bad' for row in messages):
+            raise asyncpg.exceptions.CheckViolationError('bad content')
+        self.messages.extend(row[0] for row in messages)
+
+    async def insert_rows(self, users, messages):
+        bad = []
+        for row in messages:
+            if row[5] == 'bad':
+                bad.append((row, asyncpg.exceptions.CheckViolationError('bad content')))
+            else:
+                self.messages.append(row[0])
+        return [], bad
+
+class Author:
+    id = 1
+    username = 'user'
+    discriminator = '0'
+    avatar = None
+    bot = False
+    system = False
+    public_flags = 0
+
+class Message:
+    author = Author()
+
+    def __init__(self, id, content = 'hello'):
+        self.record = (id, 2, 1, 0, False, content)
+
+def test_bad_row_does_not_block_later_flushes():
+    async def run():
+        database = Database()
+        writer = BatchWriter(database, max_rows = 1000)
+        await writer.put_message(Message(1))
+        await writer.put_message(Message(2, 'bad'))
+        await writer.put_message(Message(3))
+        await writer.flush()
+
+        await writer.put_message(Message(4))
+        await writer.flush()
+
+        assert database.messages == [1, 3, 4]
+        assert writer.rejected_rows == 1
+        assert writer.pending == 0
+
+    asyncio.run(run())
+
+def test_connection_errors_requeue():
+    async def run():
+        database = Database(down = 1)
+        writer = BatchWriter(database, max_rows = 1000)
+        await writer.put_message(Message(1))
+        await writer.flush()
+        assert writer.pending == 2 and writer.failed_flushes == 1
+
+        await writer.flush()
+        assert database.messages == [1]
+
+    asyncio.run(run())